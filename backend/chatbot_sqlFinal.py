@@ -1,15 +1,21 @@
 import os, sys
 import logging
+import threading
+import hashlib
+import time
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Set, Tuple
 import pandas as pd
 import re
 import numpy as np
-from fuzzywuzzy import fuzz
+from rapidfuzz import fuzz, process
 import json
+from functools import lru_cache, partial
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -34,9 +40,75 @@ if not GEMINI_API_KEY:
 # Cache for dataframe to avoid repeated database calls
 _df_cache = None
 _data_analysis_cache = None
-_conversation_context = {}  # Store conversation context by session ID
+_conversation_context = OrderedDict()  # Store conversation context by session ID, least recently active first
+_session_last_active = {}  # Monotonic time of each session's last message
+_session_locks = {}  # Lock per session ID, held while one of its messages is processed
 _entity_extraction_llm = None
 _search_llm = None
+_entity_system_message = None
+_agent_frame = None  # Quotation data as handed to the dataframe agent
+_default_system_prompt = None
+_llm_json_cache = OrderedDict()  # JSON LLM responses by (system prompt digest, prompt), least recently used first
+_entity_cache = OrderedDict()  # Extracted entities by (message, last question type), least recently used first
+_agent_answer_cache = OrderedDict()  # Agent answers by (message, system prompt digest, recent history), least recently used first
+
+# Guards lazy initialization of the caches above when requests run on worker threads
+_cache_lock = threading.RLock()
+
+# Guards the session store (contexts, activity times and locks); sessions idle longer than
+# the TTL are dropped, and at most _MAX_SESSIONS are kept, so memory stays bounded on a
+# long-running server. The TTL is long so a user can still download a confirmed quotation
+# days later; a dropped session's download returns "Session not found"
+_session_lock = threading.Lock()
+_SESSION_TTL_SECONDS = 7 * 24 * 60 * 60
+_MAX_SESSIONS = 10000
+
+# Entries kept in the LLM result caches above
+_MAX_LLM_JSON_RESPONSES = 1024
+_MAX_ENTITY_RESULTS = 4096
+_MAX_AGENT_ANSWERS = 256
+
+# Turns kept in a session's chat history; prompts only ever look at the last few
+_MAX_CHAT_HISTORY = 32
+
+# Runs independent LLM calls for a turn side by side (they spend their time waiting on the network).
+# Every request thread may have a call in here, so it is as large as the threadpool FastAPI runs
+# requests in (anyio's default of 40 threads); a smaller pool would queue turns behind each other
+_LLM_WORKERS = 40
+_llm_executor = ThreadPoolExecutor(max_workers=_LLM_WORKERS, thread_name_prefix="llm")
+
+# Columns computed in get_quotation_data() rather than read from the database
+_DERIVED_COLUMNS = ['item_description_lc', 'hp_exact', 'hp_range_min', 'hp_range_max', 'hp_range_term']
+
+# Horsepower in service descriptions: exact sizes ("3.0HP") and ranges ("3.0HP TO 4.0HP")
+_HP_EXACT_RE = re.compile(r'(\d+\.?\d*)HP(?!\s+TO)', re.IGNORECASE)
+_HP_RANGE_RE = re.compile(r'(\d+\.?\d*)HP\s+TO\s+(\d+\.?\d*)HP', re.IGNORECASE)
+
+# Money columns, stored as float32 in the cached frame
+_PRICE_COLUMNS = ['unit_price', 'subtotal', 'tax', 'total']
+
+# Description keywords for each known service type
+_SERVICE_TYPE_FILTER_TERMS = {
+    'chemical_cleaning': ['chemical', 'chem'],
+    'basic_servicing': ['basic', 'general', 'normal'],
+    'gas_topup': ['gas', 'top up', 'refill'],
+}
+
+def _lru_get(cache: OrderedDict, key):
+    """Look up a key in one of the LLM result caches, or return None"""
+    with _cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+def _lru_put(cache: OrderedDict, key, value, max_size: int):
+    """Store a value in one of the LLM result caches, dropping the least recently used entry when full"""
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > max_size:
+            cache.popitem(last=False)
 
 # Sample data for testing - replace this with your actual data loading function
 from connection import get_quotation_data_as_df
@@ -44,167 +116,359 @@ def get_quotation_data():
     """Get quotation data with caching to avoid repeated database calls"""
     global _df_cache
     if _df_cache is None:
-        try:
-            # Use the function from connection.py to get data from the database
-            _df_cache = get_quotation_data_as_df()
-            
-            # Check if we got valid data
-            if _df_cache is None or _df_cache.empty:
-                logger.error("Failed to retrieve data from database or empty dataset returned")
-                raise ValueError("Failed to retrieve data from database or empty dataset returned")
-            
-            logger.info(f"Loaded quotation data from database with {len(_df_cache)} rows")
-            
-            # Ensure the dataframe has the required columns
-            required_columns = ['invoice_no', 'company_name', 'item_description', 
-                               'category', 'quantity', 'unit_price', 'subtotal', 'tax', 'total']
-            
-            missing_columns = [col for col in required_columns if col not in _df_cache.columns]
-            if missing_columns:
-                logger.error(f"Database data is missing required columns: {missing_columns}")
-                raise ValueError(f"Database data is missing required columns: {missing_columns}")
+        with _cache_lock:
+            # Re-check: another thread may have filled the cache while we waited
+            if _df_cache is None:
+                try:
+                    # Use the function from connection.py to get data from the database
+                    df = get_quotation_data_as_df()
+            
+                    # Check if we got valid data
+                    if df is None or df.empty:
+                        logger.error("Failed to retrieve data from database or empty dataset returned")
+                        raise ValueError("Failed to retrieve data from database or empty dataset returned")
+            
+                    logger.info(f"Loaded quotation data from database with {len(df)} rows")
+            
+                    # Ensure the dataframe has the required columns
+                    required_columns = ['invoice_no', 'company_name', 'item_description', 
+                                       'category', 'quantity', 'unit_price', 'subtotal', 'tax', 'total']
+            
+                    missing_columns = [col for col in required_columns if col not in df.columns]
+                    if missing_columns:
+                        logger.error(f"Database data is missing required columns: {missing_columns}")
+                        raise ValueError(f"Database data is missing required columns: {missing_columns}")
+
+                    # Lowercase descriptions once so keyword filters don't redo it per request
+                    df['item_description_lc'] = df['item_description'].str.lower()
+
+                    # Parse horsepower sizes and ranges once instead of on every service search
+                    df['hp_exact'] = [
+                        [(hp_text, float(hp_text)) for hp_text in _HP_EXACT_RE.findall(description)]
+                        for description in df['item_description'].tolist()
+                    ]
+                    hp_ranges = df['item_description'].str.extract(_HP_RANGE_RE)
+                    df['hp_range_min'] = hp_ranges[0].astype(float)
+                    df['hp_range_max'] = hp_ranges[1].astype(float)
+                    df['hp_range_term'] = (hp_ranges[0] + 'HP TO ' + hp_ranges[1] + 'HP').where(hp_ranges[0].notna(), None)
+
+                    # Few distinct categories: integer codes make equality filters and groupbys cheaper
+                    df['category'] = df['category'].astype('category')
+
+                    # Prices are two-decimal Ringgit amounts; the narrower columns halve what every
+                    # price aggregation scans. float32 is only approximate at cent resolution, so
+                    # values leaving the module go through _to_prices() to round back to cents
+                    for column in _PRICE_COLUMNS:
+                        df[column] = pd.to_numeric(df[column], downcast='float')
+                    df['quantity'] = pd.to_numeric(df['quantity'], downcast='integer')
+
+                    # Publish only once fully prepared; readers check the cache without the lock
+                    _df_cache = df
                 
-        except Exception as e:
-            logger.error(f"Error loading quotation data from database: {e}")
-            raise ValueError(f"Failed to load quotation data from database: {e}")
+                except Exception as e:
+                    logger.error(f"Error loading quotation data from database: {e}")
+                    raise ValueError(f"Failed to load quotation data from database: {e}")
     
     return _df_cache
 
+def _to_prices(values) -> List[float]:
+    """Convert float32 prices to Python floats rounded back to cents (2616.82, not 2616.820068359375)"""
+    return np.round(np.asarray(values, dtype=np.float64), 2).tolist()
+
 def get_entity_extraction_llm():
     """Get or initialize the LLM for entity extraction"""
     global _entity_extraction_llm
     if _entity_extraction_llm is None:
-        try:
-            _entity_extraction_llm = ChatGoogleGenerativeAI(
-                model="gemini-2.0-flash", 
-                api_key=GEMINI_API_KEY,
-                temperature=0.1  # Low temperature for more consistent entity extraction
-            )
-            logger.info("Initialized entity extraction LLM")
-        except Exception as e:
-            logger.error(f"Error initializing entity extraction LLM: {e}")
-            raise ValueError("Failed to initialize entity extraction LLM")
+        with _cache_lock:
+            # Re-check: another thread may have filled the cache while we waited
+            if _entity_extraction_llm is None:
+                try:
+                    _entity_extraction_llm = ChatGoogleGenerativeAI(
+                        model="gemini-2.0-flash", 
+                        api_key=GEMINI_API_KEY,
+                        temperature=0.1,  # Low temperature for more consistent entity extraction
+                        response_mime_type="application/json"  # Every prompt sent to this client asks for a JSON object
+                    )
+                    logger.info("Initialized entity extraction LLM")
+                except Exception as e:
+                    logger.error(f"Error initializing entity extraction LLM: {e}")
+                    raise ValueError("Failed to initialize entity extraction LLM")
     return _entity_extraction_llm
 
 def get_search_llm():
     """Get or initialize the LLM for search matching"""
     global _search_llm
     if _search_llm is None:
-        try:
-            _search_llm = ChatGoogleGenerativeAI(
-                model="gemini-2.0-flash",  # Using the supported model name
-                api_key=GEMINI_API_KEY,
-                temperature=0.2
-            )
-            logger.info("Initialized search matching LLM")
-        except Exception as e:
-            logger.error(f"Error initializing search matching LLM: {e}")
-            raise ValueError("Failed to initialize search matching LLM")
+        with _cache_lock:
+            # Re-check: another thread may have filled the cache while we waited
+            if _search_llm is None:
+                try:
+                    _search_llm = ChatGoogleGenerativeAI(
+                        model="gemini-2.0-flash",  # Using the supported model name
+                        api_key=GEMINI_API_KEY,
+                        temperature=0.2
+                    )
+                    logger.info("Initialized search matching LLM")
+                except Exception as e:
+                    logger.error(f"Error initializing search matching LLM: {e}")
+                    raise ValueError("Failed to initialize search matching LLM")
     return _search_llm
 
+def get_agent_frame():
+    """Get the quotation data as the dataframe agent sees it, built once per data load"""
+    global _agent_frame
+    if _agent_frame is None:
+        with _cache_lock:
+            # Re-check: another thread may have filled the cache while we waited
+            if _agent_frame is None:
+                # Get data (without the helper columns added at load time), with float64
+                # prices rounded to cents so the agent doesn't see or print float32 noise
+                df = get_quotation_data().drop(columns=_DERIVED_COLUMNS, errors='ignore')
+                df[_PRICE_COLUMNS] = df[_PRICE_COLUMNS].astype(np.float64).round(2)
+                # Quantity is downcast to the narrowest integer type at load; widen it back so
+                # arithmetic in the agent's generated code can't silently overflow
+                if pd.api.types.is_integer_dtype(df['quantity']):
+                    df['quantity'] = df['quantity'].astype(np.int64)
+                _agent_frame = df
+    return _agent_frame
+
+def create_dataframe_agent():
+    """
+    Create a pandas dataframe agent over its own copy of the data.
+
+    The agent's Python tool keeps whatever the generated code does to `df` (reassigning,
+    filtering, inplace edits) for as long as the tool lives, so each question gets a
+    fresh agent and frame; only the LLM client is shared.
+    """
+    # Imported here: langchain_experimental is heavy and the agent is only a fallback
+    from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
+
+    # Same model and temperature as search matching, so share the client
+    return create_pandas_dataframe_agent(
+        get_search_llm(),
+        get_agent_frame().copy(),
+        verbose=True,
+        agent_type="zero-shot-react-description",
+        handle_parsing_errors=True,
+        max_iterations=3,
+        allow_dangerous_code=True
+    )
+
+def _invoke_llm_json(system_prompt: str, prompt: str) -> str:
+    """
+    Stream the entity extraction LLM's response and stop as soon as it has produced a complete JSON object.
+    Returns the text received so far (the whole response if it never contains one).
+    """
+    llm = get_entity_extraction_llm()
+    response_text = ""
+    for chunk in llm.stream([
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=prompt)
+    ]):
+        response_text += chunk.content
+        # Anything after the closing brace (explanations, code fences) isn't needed
+        if '}' in chunk.content and _extract_json_object(response_text) is not None:
+            break
+    return response_text
+
+def _invoke_llm_json_cached(system_prompt: str, prompt: str) -> str:
+    """
+    Invoke the LLM for a JSON answer and return the response text.
+    Memoized on the exact prompts so repeated questions skip the round-trip. Only responses that
+    hold a parseable JSON object are kept: an empty, truncated or malformed reply (or an error)
+    is asked for again next time rather than sticking to the prompt.
+    """
+    key = (hashlib.sha1(system_prompt.encode()).digest(), prompt)
+    response_text = _lru_get(_llm_json_cache, key)
+    if response_text is None:
+        response_text = _invoke_llm_json(system_prompt, prompt)
+        if _has_json_object(response_text):
+            _lru_put(_llm_json_cache, key, response_text, _MAX_LLM_JSON_RESPONSES)
+    return response_text
+
 def analyze_data():
     """Analyze the data to extract useful information for quotations"""
     global _data_analysis_cache
     if _data_analysis_cache is None:
-        try:
-            df = get_quotation_data()
-            
-            # Get categories
-            categories = df['category'].unique().tolist()
-            
-            # Extract all unique service descriptions for matching
-            all_services = {}
-            for _, row in df.iterrows():
-                service_id = f"{row['invoice_no']}_{row['item_description']}"
-                all_services[service_id] = {
-                    'category': row['category'],
-                    'description': row['item_description'],
-                    'unit_price': row['unit_price'],
-                    'subtotal': row['subtotal'],
-                    'tax': row['tax'],
-                    'total': row['total']
-                }
-            
-            # Analyze each category
-            category_analysis = {}
-            for category in categories:
-                category_df = df[df['category'] == category]
-                
-                # Get common services
-                common_services = []
-                for _, row in category_df.drop_duplicates(subset=['item_description']).iterrows():
-                    common_services.append({
-                        'description': row['item_description'],
-                        'unit_price': row['unit_price']
-                    })
-                
-                # Get price ranges
-                price_range = {
-                    'min': category_df['unit_price'].min(),
-                    'max': category_df['unit_price'].max(),
-                    'median': category_df['unit_price'].median(),
-                    'mean': category_df['unit_price'].mean()
-                }
-                
-                # Store the analysis
-                category_analysis[category] = {
-                    'count': len(category_df),
-                    'common_services': common_services,
-                    'price_range': price_range,
-                    'services': category_df['item_description'].tolist()
-                }
-            
-            # Store the analysis in the cache
-            _data_analysis_cache = {
-                'categories': categories,
-                'category_analysis': category_analysis,
-                'all_services': all_services
-            }
+        with _cache_lock:
+            # Re-check: another thread may have filled the cache while we waited
+            if _data_analysis_cache is None:
+                try:
+                    df = get_quotation_data()
+            
+                    # Get categories
+                    categories = df['category'].unique().tolist()
+            
+                    # Extract all unique service descriptions for matching, stored
+                    # column-wise with an index from service id to row position
+                    service_ids = (df['invoice_no'].astype(str) + '_' + df['item_description']).to_numpy()
+                    all_services = {
+                        'index': {service_id: i for i, service_id in enumerate(service_ids)},
+                        'category': df['category'].to_numpy(dtype=object),
+                        'description': df['item_description'].to_numpy(dtype=object),
+                        'unit_price': df['unit_price'].to_numpy(),
+                        'subtotal': df['subtotal'].to_numpy(),
+                        'tax': df['tax'].to_numpy(),
+                        'total': df['total'].to_numpy()
+                    }
+
+                    # Aggregate every category in a single grouped pass rather than
+                    # filtering the frame and reducing it separately per category
+                    category_groups = df.groupby('category', sort=False, observed=True)
+                    price_stats = category_groups['unit_price'].agg(['min', 'max', 'median', 'mean', 'size']).to_dict('index')
+                    services_by_category = category_groups['item_description'].agg(list).to_dict()
+            
+                    # Keep each category's rows so lookups don't rescan the whole frame
+                    category_frames = {category: category_df for category, category_df in category_groups}
+
+                    # Get common services (first listed price of each distinct description, even if missing)
+                    common_by_category = {category: [] for category in categories}
+                    first_prices = df.groupby(['category', 'item_description'], sort=False, observed=True)['unit_price'].first(skipna=False)
+                    for (category, description), unit_price in zip(first_prices.index, _to_prices(first_prices)):
+                        common_by_category[category].append({'description': description, 'unit_price': unit_price})
+
+                    # Analyze each category
+                    category_analysis = {}
+                    for category in categories:
+                        stats = price_stats.get(category)
+                        if stats is None:
+                            continue
+
+                        # Store the analysis
+                        category_analysis[category] = {
+                            'count': int(stats['size']),
+                            'common_services': common_by_category[category],
+                            'price_range': dict(zip(
+                                ['min', 'max', 'median', 'mean'],
+                                _to_prices([stats['min'], stats['max'], stats['median'], stats['mean']])
+                            )),
+                            'services': services_by_category[category]
+                        }
             
-            logger.info("Data analysis completed")
-        except Exception as e:
-            logger.error(f"Error analyzing data: {e}")
-            raise ValueError("Failed to analyze data")
+                    # Precompute row masks for every (category, known service type) so
+                    # price and popularity lookups don't rescan descriptions per request.
+                    # Each mask indexes its category's frame in category_frames, which comes
+                    # from this same snapshot of the data
+                    service_masks = {}
+                    for service_type in _SERVICE_TYPE_FILTER_TERMS:
+                        type_mask = df['item_description_lc'].str.contains(_service_type_pattern(service_type), na=False).to_numpy()
+                        for category in category_frames:
+                            service_masks[(category, service_type)] = type_mask[category_groups.indices[category]]
+            
+                    # Lay out each category's exact HP sizes as NaN-padded (values, texts)
+                    # matrices, one row per service, so HP lookups are array comparisons
+                    hp_exact = {}
+                    for category, category_df in category_frames.items():
+                        hp_lists = category_df['hp_exact'].tolist()
+                        width = max(map(len, hp_lists), default=0)
+                        hp_values = np.full((len(hp_lists), width), np.nan)
+                        hp_texts = np.empty((len(hp_lists), width), dtype=object)
+                        for row, hp_matches in enumerate(hp_lists):
+                            for column, (hp_text, hp_value) in enumerate(hp_matches):
+                                hp_values[row, column] = hp_value
+                                hp_texts[row, column] = hp_text
+                        hp_exact[category] = (hp_values, hp_texts)
+                    
+                    # Keep only the services that list an HP range, in row order
+                    hp_ranges = {}
+                    for category, category_df in category_frames.items():
+                        ranged_df = category_df[category_df['hp_range_term'].notna()]
+                        hp_ranges[category] = (
+                            ranged_df['hp_range_min'].to_numpy(),
+                            ranged_df['hp_range_max'].to_numpy(),
+                            ranged_df['hp_range_term'].to_numpy()
+                        )
+                    
+                    # Store the analysis in the cache
+                    _data_analysis_cache = {
+                        'categories': categories,
+                        'category_analysis': category_analysis,
+                        'all_services': all_services,
+                        'service_masks': service_masks,
+                        'category_frames': category_frames,
+                        'hp_exact': hp_exact,
+                        'hp_ranges': hp_ranges
+                    }
+            
+                    logger.info("Data analysis completed")
+                except Exception as e:
+                    logger.error(f"Error analyzing data: {e}")
+                    raise ValueError("Failed to analyze data")
     
     return _data_analysis_cache
 
+def _service_type_pattern(service_type):
+    """Build the description regex used to filter rows by service type"""
+    filter_terms = _SERVICE_TYPE_FILTER_TERMS.get(service_type, [service_type.replace('_', ' ')])
+    return '|'.join(re.escape(term.lower()) for term in filter_terms)
+
+def _filter_by_service_type(category, service_type, analysis):
+    """Return the rows of a category whose description matches the service type"""
+    category_df = analysis['category_frames'][category]
+    mask = analysis['service_masks'].get((category, service_type))
+    if mask is not None:
+        return category_df[mask]
+    
+    # Service type without a precomputed mask - filter the category's rows on the fly
+    return category_df[category_df['item_description_lc'].str.contains(_service_type_pattern(service_type), na=False)]
+
+# Keyword alternations for intent classification, compiled once so each
+# message is scanned in a single pass per intent class. Keywords must start
+# a word ("prices" and "information" match, "surprise" does not)
+_INFO_INTENT_RE = re.compile(r'\b(?:what is|how much|price|cost|average|popular|common|statistics|tell me about|info)')
+_POPULAR_INTENT_RE = re.compile(r'\b(?:most popular|common|frequently)')
+_PRICE_INTENT_RE = re.compile(r'\b(?:price|cost|how much|average cost)')
+_QUOTE_INTENT_RE = re.compile(r'\b(?:quote|quotation|get a quote|want to|need to|service|hire|book)')
+
 def classify_user_intent(message, context=None):
     """
     Classify user intent into categories: information_request, quotation_request, confirmation, etc.
     """
     message_lower = message.lower()
     
+    # Check for informational queries and quotation requests
+    keyword_intent = _classify_intent_by_keywords(message_lower)
+    if keyword_intent:
+        return keyword_intent
+    
+    # Check for confirmation or rejection (a bare number, like a quantity or HP size, is neither).
+    # Not memoized here: these may ask the LLM, whose successful answers are cached on their own,
+    # while a phrase fallback after an LLM error must not stick to the message
+    if not _is_plain_number(message_lower.strip()):
+        if is_confirmation_message(message):
+            return "confirmation"
+        if is_negative_response(message):
+            return "rejection"
+    
+    # Check if this is a direct answer to a question
+    if context and context.get('last_question_type'):
+        return "direct_answer"
+    
+    # Default to generic request
+    return "generic_request"
+
+@lru_cache(maxsize=1024)
+def _classify_intent_by_keywords(message_lower):
+    """Classify a lowercased message by intent keywords alone, or return None; memoized since it is classified several times per turn"""
     # Check for informational queries
-    info_keywords = ["what is", "how much", "price", "cost", "average", "popular", "common", "statistics", "tell me about", "info"]
-    if any(keyword in message_lower for keyword in info_keywords):
+    if _INFO_INTENT_RE.search(message_lower):
         # Further classify the type of information
-        if any(term in message_lower for term in ["most popular", "common", "frequently"]):
+        if _POPULAR_INTENT_RE.search(message_lower):
             return "popular_services_info"
-        elif any(term in message_lower for term in ["price", "cost", "how much", "average cost"]):
+        elif _PRICE_INTENT_RE.search(message_lower):
             return "price_info"
         return "information_request"
     
     # Check for quotation requests
-    quote_keywords = ["quote", "quotation", "get a quote", "want to", "need to", "service", "hire", "book"]
-    if any(keyword in message_lower for keyword in quote_keywords):
+    if _QUOTE_INTENT_RE.search(message_lower):
         return "quotation_request"
     
-    # Check for confirmation or rejection
-    if is_confirmation_message(message):
-        return "confirmation"
-    if is_negative_response(message):
-        return "rejection"
-    
-    # Check if this is a direct answer to a question
-    if context and context.get('last_question_type'):
-        return "direct_answer"
-    
-    # Default to generic request
-    return "generic_request"
+    return None
 
-def get_price_estimate(category, service_type=None):
+def get_price_estimate(category, service_type=None, analysis=None):
     """Get price estimate information for a category and optional service type"""
-    analysis = analyze_data()
+    if analysis is None:
+        analysis = analyze_data()
     
     if category in analysis['category_analysis']:
         category_data = analysis['category_analysis'][category]
@@ -215,29 +479,17 @@ def get_price_estimate(category, service_type=None):
         
         # If service type is specified, try to provide more specific information
         if service_type:
-            df = get_quotation_data()
-            category_df = df[df['category'] == category]
-            
-            # Create a filter based on service type keywords
-            if service_type == 'chemical_cleaning':
-                filter_terms = ['chemical', 'chem']
-            elif service_type == 'basic_servicing':
-                filter_terms = ['basic', 'general', 'normal']
-            elif service_type == 'gas_topup':
-                filter_terms = ['gas', 'top up', 'refill']
-            else:
-                filter_terms = [service_type.replace('_', ' ')]
-                
-            # Apply the filter
-            filtered_df = category_df[category_df['item_description'].str.lower().apply(
-                lambda x: any(term in x.lower() for term in filter_terms))]
+            # Filter by the service type's description keywords
+            filtered_df = _filter_by_service_type(category, service_type, analysis)
             
             # If we have results after filtering, provide more specific price info
             if not filtered_df.empty:
                 service_type_display = service_type.replace('_', ' ').title()
-                specific_min = filtered_df['unit_price'].min()
-                specific_max = filtered_df['unit_price'].max()
-                specific_median = filtered_df['unit_price'].median()
+                # Reduce the raw float array directly; NaN-aware like the pandas reductions
+                prices = filtered_df['unit_price'].to_numpy(dtype=np.float64)
+                specific_min = np.nanmin(prices)
+                specific_max = np.nanmax(prices)
+                specific_median = np.nanmedian(prices)
                 
                 price_info = f"For {category} - {service_type_display}, prices typically range from RM {specific_min:.2f} to RM {specific_max:.2f}, with the median price being RM {specific_median:.2f}."
         
@@ -255,45 +507,37 @@ def get_price_estimate(category, service_type=None):
     
     return f"I don't have detailed pricing information for {category} at the moment. Would you like me to provide a specific quote based on your requirements?"
 
-def get_popular_services(category, service_type=None):
+def _most_common_services(services_df, limit=5):
+    """Get the most frequent services in a frame with their first listed price (even if missing) and count"""
+    service_groups = services_df.groupby('item_description', sort=False)
+    service_stats = pd.DataFrame({
+        'unit_price': service_groups['unit_price'].first(skipna=False),
+        'count': service_groups.size()
+    }).sort_values('count', ascending=False, kind='stable').head(limit)
+    
+    return [
+        {'description': desc, 'unit_price': price, 'count': count}
+        for desc, price, count in zip(service_stats.index.tolist(), _to_prices(service_stats['unit_price']), service_stats['count'].tolist())
+    ]
+
+def get_popular_services(category, service_type=None, analysis=None):
     """Get popular services for a category and optional service type based on analyzed data"""
-    analysis = analyze_data()
-    df = get_quotation_data()
+    if analysis is None:
+        analysis = analyze_data()
     
     if category in analysis['category_analysis']:
         # Filter by category
-        category_df = df[df['category'] == category]
+        category_df = analysis['category_frames'][category]
         
         # If service type is specified, further filter the data
         if service_type:
-            # Create a filter based on service type keywords
-            if service_type == 'chemical_cleaning':
-                filter_terms = ['chemical', 'chem']
-            elif service_type == 'basic_servicing':
-                filter_terms = ['basic', 'general', 'normal']
-            elif service_type == 'gas_topup':
-                filter_terms = ['gas', 'top up', 'refill']
-            else:
-                filter_terms = [service_type.replace('_', ' ')]
-                
-            # Apply the filter
-            filtered_df = category_df[category_df['item_description'].str.lower().apply(
-                lambda x: any(term in x.lower() for term in filter_terms))]
+            # Filter by the service type's description keywords
+            filtered_df = _filter_by_service_type(category, service_type, analysis)
             
             # If we have results after filtering, use them; otherwise, fall back to category
             if not filtered_df.empty:
-                # Get service counts
-                service_counts = filtered_df['item_description'].value_counts()
-                
                 # Get the most common services with counts
-                common_services = []
-                for desc, count in service_counts.head(5).items():
-                    price = filtered_df[filtered_df['item_description'] == desc]['unit_price'].iloc[0]
-                    common_services.append({
-                        'description': desc,
-                        'unit_price': price,
-                        'count': count
-                    })
+                common_services = _most_common_services(filtered_df)
                 
                 if common_services:
                     service_type_display = service_type.replace('_', ' ').title()
@@ -301,16 +545,7 @@ def get_popular_services(category, service_type=None):
                     return f"Our most popular {category} - {service_type_display} services are:\n\n{services_text}"
         
         # If no service type specified or no matches found, return category-level popular services
-        service_counts = category_df['item_description'].value_counts()
-        common_services = []
-        
-        for desc, count in service_counts.head(5).items():
-            price = category_df[category_df['item_description'] == desc]['unit_price'].iloc[0]
-            common_services.append({
-                'description': desc,
-                'unit_price': price,
-                'count': count  
-            })
+        common_services = _most_common_services(category_df)
             
         if common_services:
             services_text = "\n".join([f"- {s['description']} (RM {s['unit_price']:.2f})" for s in common_services])
@@ -338,10 +573,13 @@ def handle_information_request(message, context):
             context['service_type'] = service_type
             logger.info(f"Updated context service_type = {service_type}")
         
+        # Look up the analysis once and share it with the helpers below
+        analysis = analyze_data()
+        
         # Handle price information requests
         if intent == "price_info" and category:
-            price_info = get_price_estimate(category, service_type)
-            popular_services = get_popular_services(category, service_type)
+            price_info = get_price_estimate(category, service_type, analysis=analysis)
+            popular_services = get_popular_services(category, service_type, analysis=analysis)
             response = f"Here's the information about pricing:\n\n{price_info}\n\n"
             if popular_services:
                 response += f"{popular_services}\n\n"
@@ -350,12 +588,11 @@ def handle_information_request(message, context):
         
         # Handle requests for popular services
         elif intent == "popular_services_info" and category:
-            popular_services = get_popular_services(category, service_type)
+            popular_services = get_popular_services(category, service_type, analysis=analysis)
             if popular_services:
                 return {"response": popular_services, "has_quotation": False, "needs_more_info": False}
             else:
                 # Fall back to a generic response if we can't provide specific information
-                analysis = analyze_data()
                 if category in analysis['category_analysis']:
                     common_services = analysis['category_analysis'][category]['common_services'][:5]
                     
@@ -394,30 +631,163 @@ def handle_information_request(message, context):
             "needs_more_info": True
         }
 
-def extract_entities_with_llm(message: str, context: Dict = None) -> Dict:
-    """Extract entities from a message using the LLM"""
+def _extract_json_object(text: str):
+    """
+    Return the first balanced {...} object in an LLM response, or None.
+
+    Single forward scan that tracks brace depth and skips braces inside
+    string literals, instead of a greedy regex over the whole response.
+    """
+    start = text.find('{')
+    if start < 0:
+        return None
+    
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+def _has_json_object(text: str) -> bool:
+    """Check if an LLM response contains a JSON object that parses"""
+    json_str = _extract_json_object(text)
+    if json_str is None:
+        return False
     try:
-        # Special case for when user just says "aircon" - automatically interpret as Aircon Servicing
-        message_lower = message.lower().strip()
-        if message_lower == "aircon":
-            return {'category': 'Aircon Servicing'}
-        
-        # Check for direct answers to previous questions first
-        if context and context.get('last_question_type'):
-            direct_response = handle_direct_response(message, context.get('last_question_type'))
-            if direct_response:
-                logger.info(f"Extracted direct response: {direct_response}")
-                return direct_response
-        
-        # Get the LLM
-        llm = get_entity_extraction_llm()
-        
-        # Get data analysis to understand available categories and services
-        analysis = analyze_data()
-        categories = analysis['categories']
-        
-        # Create a system prompt for entity extraction
-        system_prompt = f"""You are an entity extraction assistant for a quotation system. Extract structured information from the user's message about service requests.
+        return isinstance(json.loads(json_str), dict)
+    except json.JSONDecodeError:
+        return False
+
+def _parse_json_response(text: str):
+    """Parse the JSON object in an LLM response; raises json.JSONDecodeError if there isn't one"""
+    json_str = _extract_json_object(text)
+    # If no JSON object found, try to parse the whole response
+    return json.loads(json_str if json_str is not None else text)
+
+# Field patterns for pulling entities out of a non-JSON LLM response
+_ENTITY_FIELD_RES = {
+    field: re.compile(rf"{field}[:\s]+([a-zA-Z0-9_\.]+)", re.IGNORECASE)
+    for field in ["unit_type", "service_type", "hp_size", "brand", "fixture_type", "issue_type", "quantity"]
+}
+
+def _compile_keyword_table(pairs):
+    """
+    Compile ordered (keyword, value) pairs into a single-pass matcher.
+
+    The lookahead alternation reports every position where a keyword starts,
+    so one finditer() over the message finds all keywords. Table order still
+    decides which value wins, like the if/elif chains it replaces.
+    """
+    priorities = {}
+    for priority, (keyword, value) in enumerate(pairs):
+        priorities.setdefault(keyword, (priority, value))
+    alternation = '|'.join(re.escape(keyword) for keyword in sorted(priorities, key=len, reverse=True))
+    return re.compile(f'(?=({alternation}))'), priorities
+
+def _first_keyword_match(text: str, keyword_table) -> str:
+    """Return the value of the highest-priority keyword that occurs in the text"""
+    pattern, priorities = keyword_table
+    best = None
+    for match in pattern.finditer(text):
+        hit = priorities[match.group(1)]
+        if best is None or hit[0] < best[0]:
+            best = hit
+    return best[1] if best else None
+
+# Patterns for horsepower and bare numeric answers (applied to lowercased text)
+_HP_RE = re.compile(r'(\d+(?:\.\d+)?)\s*hp')
+_INTEGER_RE = re.compile(r'^\s*(\d+)\s*$')
+_HP_ANSWER_RE = re.compile(r'^(\d+(?:\.\d+)?)(?:\s*hp)?$')
+
+def _is_plain_number(text: str) -> bool:
+    """Check if text is just digits with an optional decimal part (e.g. "2", "1.5")"""
+    whole, dot, fraction = text.partition('.')
+    return whole.isdecimal() and (not dot or fraction.isdecimal())
+
+# (keyword, value) tables for the rule-based pass in extract_entities_with_llm.
+# Order matters: the earliest keyword in the table that occurs in the message wins.
+_UNIT_TYPE_KEYWORDS = _compile_keyword_table((
+    ("wall mounted", "wall"), ("wall-mounted", "wall"), ("window", "window"),
+    ("cassette", "cassette"), ("ceiling", "ceiling"),
+))
+_SERVICE_TYPE_KEYWORDS = _compile_keyword_table((
+    ("general cleaning", "basic_servicing"), ("basic cleaning", "basic_servicing"),
+    ("chemical", "chemical_cleaning"),
+    ("gas", "gas_topup"), ("top up", "gas_topup"), ("refill", "gas_topup"),
+))
+_FIXTURE_TYPE_KEYWORDS = _compile_keyword_table((
+    ("toilet", "toilet"), ("wc", "toilet"), ("sink", "sink"), ("basin", "sink"),
+    ("pipe", "pipe"), ("drain", "pipe"),
+))
+_ISSUE_TYPE_KEYWORDS = _compile_keyword_table((
+    ("leak", "leaking"), ("clog", "clogged"), ("block", "clogged"),
+))
+
+# Exact answers to a unit type question (most split units are wall-mounted)
+_UNIT_TYPE_ANSWERS = {
+    **dict.fromkeys(['wall', 'wall mounted', 'wall-mounted'], 'wall'),
+    **dict.fromkeys(['window', 'window unit', 'window-unit', 'window type'], 'window'),
+    **dict.fromkeys(['ceiling', 'ceiling mounted', 'ceiling-mounted'], 'ceiling'),
+    **dict.fromkeys(['cassette', 'cassette type', 'cassette-type'], 'cassette'),
+    **dict.fromkeys(['split', 'split unit', 'split-unit'], 'wall'),
+}
+
+# Keyword tables for direct answers to a specific question (handle_direct_response)
+_ANSWER_KEYWORDS = {
+    'service_type': _compile_keyword_table(
+        [(term, 'basic_servicing') for term in ('basic', 'general', 'normal', 'regular', 'standard')]
+        + [(term, 'chemical_cleaning') for term in ('chemical', 'deep', 'thorough', 'complete')]
+        + [(term, 'gas_topup') for term in ('gas', 'top up', 'refill', 'recharge')]
+        + [(term, 'installation') for term in ('install', 'installation', 'setup', 'set up')]
+        + [(term, 'repair') for term in ('repair', 'fix', 'troubleshoot')]
+    ),
+    'quantity': _compile_keyword_table([
+        ('one', 1), ('two', 2), ('three', 3), ('four', 4), ('five', 5),
+        ('six', 6), ('seven', 7), ('eight', 8), ('nine', 9), ('ten', 10)
+    ]),
+    'brand': _compile_keyword_table(
+        [(brand, brand) for brand in ('daikin', 'panasonic', 'samsung', 'lg', 'mitsubishi', 'hitachi', 'toshiba', 'sharp', 'carrier')]
+    ),
+    'fixture_type': _compile_keyword_table(
+        [(term, 'toilet') for term in ('toilet', 'wc', 'bathroom')]
+        + [(term, 'sink') for term in ('sink', 'basin', 'tap', 'faucet')]
+        + [(term, 'pipe') for term in ('pipe', 'piping', 'water pipe', 'drain')]
+        + [(term, 'water_heater') for term in ('water heater', 'heater', 'hot water')]
+        + [(term, 'water_tank') for term in ('water tank', 'tank', 'storage')]
+    ),
+    'issue_type': _compile_keyword_table(
+        [(term, 'leaking') for term in ('leak', 'leaking', 'water leak')]
+        + [(term, 'clogged') for term in ('clog', 'clogged', 'blocked', 'blockage')]
+        + [(term, 'broken') for term in ('broken', 'damaged', 'not working')]
+        + [(term, 'not_cooling') for term in ('not cooling', 'no cool', 'warm air')]
+        + [(term, 'noise') for term in ('noise', 'noisy', 'loud', 'sound')]
+    ),
+}
+
+def get_entity_system_message():
+    """Get or build the entity extraction system prompt for the current categories"""
+    global _entity_system_message
+    if _entity_system_message is None:
+        categories = analyze_data()['categories']
+        
+        # The prompt only depends on the categories, so build the message once
+        _entity_system_message = SystemMessage(content=f"""You are an entity extraction assistant for a quotation system. Extract structured information from the user's message about service requests.
 
 Available service categories: {', '.join(categories)}
 
@@ -432,116 +802,187 @@ Extract the following entities if present:
 8. quantity: The number of units or services needed
 
 Return ONLY a JSON object with the extracted entities. If an entity is not present, do not include it in the JSON.
-"""
-        
-        # Create the prompt
-        prompt = f"Extract service request information from this message: {message}"
-        
-        # Invoke the LLM
-        response = llm.invoke([
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=prompt)
-        ])
-        
-        # Extract the JSON from the response
-        response_text = response.content
-        
-        # Try to find and parse JSON in the response
-        try:
-            # Look for JSON pattern
-            json_match = re.search(r'({[\s\S]*})', response_text)
-            if json_match:
-                json_str = json_match.group(1)
-                extracted_info = json.loads(json_str)
-            else:
-                # If no JSON pattern found, try to parse the whole response
-                extracted_info = json.loads(response_text)
-        except json.JSONDecodeError:
-            # If JSON parsing fails, extract information manually
-            logger.warning(f"Failed to parse JSON from LLM response: {response_text}")
-            extracted_info = {}
-            
-            # Extract category
-            if "category" in response_text.lower():
-                for category in categories:
-                    if category.lower() in response_text.lower():
-                        extracted_info["category"] = category
-                        break
-            
-            # Extract other common fields
-            for field in ["unit_type", "service_type", "hp_size", "brand", "fixture_type", "issue_type", "quantity"]:
-                if field in response_text.lower():
-                    field_match = re.search(rf"{field}[:\s]+([a-zA-Z0-9_\.]+)", response_text, re.IGNORECASE)
-                    if field_match:
-                        extracted_info[field] = field_match.group(1)
-        
-        # Manual extraction for common terms
-        if "aircon" in message_lower and not "category" in extracted_info:
-            # If message contains "aircon" and no category was extracted, default to Aircon Servicing
-            extracted_info["category"] = "Aircon Servicing"
-            
-        if "wall mounted" in message.lower() or "wall-mounted" in message.lower():
-            extracted_info["unit_type"] = "wall"
-        elif "window" in message.lower():
-            extracted_info["unit_type"] = "window"
-        elif "cassette" in message.lower():
-            extracted_info["unit_type"] = "cassette"
-        elif "ceiling" in message.lower():
-            extracted_info["unit_type"] = "ceiling"
-        elif "split" in message.lower() and "unit" in message.lower():
-            extracted_info["unit_type"] = "wall"  # Most split units are wall-mounted
-        
-        # Manual extraction for horsepower
-        hp_match = re.search(r'(\d+(\.\d+)?)\s*hp', message.lower())
-        if hp_match:
-            extracted_info["hp_size"] = hp_match.group(1)
-        elif re.match(r'^\d+(\.\d+)?$', message.strip()):
-            # If the message is just a number, it might be the HP size or quantity
-            num_value = float(message.strip())
-            if context and context.get('last_question_type') == 'hp_size':
-                extracted_info["hp_size"] = str(num_value)
-            elif context and context.get('last_question_type') == 'quantity':
-                extracted_info["quantity"] = int(num_value)
-            elif num_value > 0 and num_value <= 5:
-                # Likely HP size if between 0 and 5
-                extracted_info["hp_size"] = str(num_value)
-            elif num_value > 0 and num_value <= 20:
-                # Likely quantity if between 1 and 20
-                extracted_info["quantity"] = int(num_value)
-        
-        quantity_match = re.match(r'^\s*(\d+)\s*$', message)
-        if quantity_match and not "hp_size" in extracted_info:
-            extracted_info["quantity"] = int(quantity_match.group(1))
-        
-        # Extract service type from common terms
-        if "general cleaning" in message.lower() or "basic cleaning" in message.lower():
-            extracted_info["service_type"] = "basic_servicing"
-        elif "chemical" in message.lower() or "chemical wash" in message.lower():
-            extracted_info["service_type"] = "chemical_cleaning"
-        elif "gas" in message.lower() or "top up" in message.lower() or "refill" in message.lower():
-            extracted_info["service_type"] = "gas_topup"
-        
-        # Extract fixture type for plumbing
-        if "toilet" in message.lower() or "wc" in message.lower():
-            extracted_info["fixture_type"] = "toilet"
-        elif "sink" in message.lower() or "basin" in message.lower():
-            extracted_info["fixture_type"] = "sink"
-        elif "pipe" in message.lower() or "drain" in message.lower():
-            extracted_info["fixture_type"] = "pipe"
-        
-        # Extract issue type
-        if "leak" in message.lower():
-            extracted_info["issue_type"] = "leaking"
-        elif "clog" in message.lower() or "block" in message.lower():
-            extracted_info["issue_type"] = "clogged"
-        
-        logger.info(f"Extracted entities: {extracted_info}")
-        return extracted_info
-    
+""")
+    return _entity_system_message
+
+def extract_entities_with_llm(message: str, context: Dict = None) -> Dict:
+    """Extract entities from a message using the LLM"""
+    try:
+        last_question_type = context.get('last_question_type') if context else None
+        # Collapse whitespace so trivially different spellings of a message share a cache entry
+        key = (' '.join(message.split()), last_question_type)
+        entities = _lru_get(_entity_cache, key)
+        if entities is None:
+            entities, reliable = _extract_entities(*key)
+            # Results guessed from an unparseable LLM reply are not memoized, so the next
+            # identical message asks again instead of keeping the guess
+            if reliable:
+                _lru_put(_entity_cache, key, entities, _MAX_ENTITY_RESULTS)
+        # Copy so callers can't modify the memoized result
+        return dict(entities)
     except Exception as e:
         logger.error(f"Error extracting entities with LLM: {e}")
         return {}
+
+def _extract_entities(message: str, last_question_type: str = None) -> Tuple[Dict, bool]:
+    """
+    Extract entities for a message and the question it answers.
+    Returns the entities and whether they are reliable enough to memoize (False when the
+    LLM reply couldn't be parsed and the fields were picked out of its text).
+    """
+    # Special case for when user just says "aircon" - automatically interpret as Aircon Servicing
+    message_lower = message.lower().strip()
+    if message_lower == "aircon":
+        return {'category': 'Aircon Servicing'}, True
+    
+    # Check for direct answers to previous questions first
+    if last_question_type:
+        direct_response = handle_direct_response(message, last_question_type)
+        if direct_response:
+            logger.info(f"Extracted direct response: {direct_response}")
+            return direct_response, True
+    
+    # Get data analysis to understand available categories and services
+    analysis = analyze_data()
+    categories = analysis['categories']
+    
+    # Create the prompt
+    prompt = f"Extract service request information from this message: {message}"
+    
+    # Invoke the LLM (this result is memoized by the caller, so no second cache)
+    response_text = _invoke_llm_json(get_entity_system_message().content, prompt)
+    
+    # Try to find and parse JSON in the response
+    reliable = True
+    try:
+        extracted_info = _parse_json_response(response_text)
+    except json.JSONDecodeError:
+        # If JSON parsing fails, extract information manually
+        logger.warning(f"Failed to parse JSON from LLM response: {response_text}")
+        reliable = False
+        extracted_info = {}
+        response_lower = response_text.lower()
+        
+        # Extract category
+        if "category" in response_lower:
+            for category in categories:
+                if category.lower() in response_lower:
+                    extracted_info["category"] = category
+                    break
+        
+        # Extract other common fields
+        for field, field_re in _ENTITY_FIELD_RES.items():
+            if field in response_lower:
+                field_match = field_re.search(response_text)
+                if field_match:
+                    extracted_info[field] = field_match.group(1)
+    
+    # Map a differently-cased category (e.g. "aircon servicing") onto the known one
+    # so the missing-info table applies instead of a second LLM call
+    category = extracted_info.get("category")
+    if isinstance(category, str) and category not in categories:
+        known_categories = {known.lower(): known for known in categories}
+        extracted_info["category"] = known_categories.get(category.strip().lower(), category)
     
+    # Manual extraction for common terms
+    if "aircon" in message_lower and not "category" in extracted_info:
+        # If message contains "aircon" and no category was extracted, default to Aircon Servicing
+        extracted_info["category"] = "Aircon Servicing"
+        
+    unit_type = _first_keyword_match(message_lower, _UNIT_TYPE_KEYWORDS)
+    if unit_type:
+        extracted_info["unit_type"] = unit_type
+    elif "split" in message_lower and "unit" in message_lower:
+        extracted_info["unit_type"] = "wall"  # Most split units are wall-mounted
+    
+    # Manual extraction for horsepower
+    hp_match = _HP_RE.search(message_lower)
+    if hp_match:
+        extracted_info["hp_size"] = hp_match.group(1)
+    elif _is_plain_number(message_lower):
+        # If the message is just a number, it might be the HP size or quantity
+        num_value = float(message_lower)
+        if last_question_type == 'hp_size':
+            extracted_info["hp_size"] = str(num_value)
+        elif last_question_type == 'quantity':
+            extracted_info["quantity"] = int(num_value)
+        elif num_value > 0 and num_value <= 5:
+            # Likely HP size if between 0 and 5
+            extracted_info["hp_size"] = str(num_value)
+        elif num_value > 0 and num_value <= 20:
+            # Likely quantity if between 1 and 20
+            extracted_info["quantity"] = int(num_value)
+    
+    quantity_match = _INTEGER_RE.match(message)
+    if quantity_match and not "hp_size" in extracted_info:
+        extracted_info["quantity"] = int(quantity_match.group(1))
+    
+    # Extract service type, fixture type (plumbing) and issue type from common terms
+    for field, keyword_table in (("service_type", _SERVICE_TYPE_KEYWORDS),
+                                 ("fixture_type", _FIXTURE_TYPE_KEYWORDS),
+                                 ("issue_type", _ISSUE_TYPE_KEYWORDS)):
+        value = _first_keyword_match(message_lower, keyword_table)
+        if value:
+            extracted_info[field] = value
+    
+    logger.info(f"Extracted entities: {extracted_info}")
+    return extracted_info, reliable
+    
+# Information needed to quote each category, in the order we ask for it
+_REQUIRED_FIELDS = {
+    'Aircon Servicing': ('unit_type', 'service_type', 'hp_size', 'quantity'),
+    'Aircon Installation': ('unit_type', 'hp_size', 'brand', 'quantity'),
+    'Aircon Repair': ('unit_type', 'issue_type', 'quantity'),
+    'Plumber': ('fixture_type', 'issue_type', 'quantity')
+}
+
+# Question to ask when a required field is missing
+_MISSING_INFO_QUESTIONS = {
+    'unit_type': "What type of aircon unit is it (e.g., window, split, cassette)?",
+    'service_type': "What type of service do you need (e.g., basic servicing, chemical cleaning, gas top-up)?",
+    'hp_size': "What is the horsepower (HP) of the aircon unit?",
+    'quantity': "How many aircon units do you want to service?",
+    'brand': "What brand of aircon do you want to install?",
+    'fixture_type': "What type of plumbing fixture needs service (e.g., toilet, sink, pipe)?",
+    'issue_type': "What is the issue with your aircon unit (e.g., not cooling, noise, leaking)?"
+}
+
+def _missing_info_question(category, field, info):
+    """Get the question asking for a missing field, worded for plumbing where needed"""
+    if category == 'Plumber':
+        if field == 'quantity':
+            fixture_type = info.get('fixture_type', 'plumbing fixtures')
+            return f"How many {fixture_type}s need service?"
+        if field == 'issue_type':
+            fixture_type = info.get('fixture_type', 'plumbing fixture')
+            return f"What is the issue with your {fixture_type} (e.g., leaking, clogged, broken)?"
+    return _MISSING_INFO_QUESTIONS[field]
+
+# Field patterns for reading a non-JSON missing-info response
+_MISSING_KEY_FIELD_RE = re.compile(r"missing[_\s]key[:\s]+([a-zA-Z_]+)", re.IGNORECASE)
+_NEXT_QUESTION_FIELD_RE = re.compile(r"next[_\s]question[:\s]+(.*?)(?:\n|$)", re.IGNORECASE)
+_FIRST_QUESTION_RE = re.compile(r"([^.!?]+\?)")
+
+# System prompt for working out what is missing for categories without rules
+_MISSING_INFO_SYSTEM_PROMPT = """You are a service quotation assistant. Determine what information is missing to provide an accurate quotation.
+
+For different service categories, we need different information:
+- Aircon Servicing: unit_type, service_type, hp_size, quantity
+- Aircon Installation: unit_type, hp_size, brand, quantity
+- Aircon Repair: unit_type, issue_type, quantity
+- Plumber: fixture_type, issue_type, quantity
+
+Your task is to:
+1. Analyze the information we already have
+2. Determine what critical information is missing
+3. Generate a natural question to ask the user to get this information
+
+Return your response as a JSON object with:
+- has_enough_info: true/false
+- missing_key: the key of the missing information (if any)
+- next_question: the question to ask the user (if needed)
+"""
+
 def determine_missing_info_with_llm(info: Dict) -> Dict:
     """Use the LLM to determine what information is missing and generate a question to ask the user"""
     try:
@@ -555,79 +996,17 @@ def determine_missing_info_with_llm(info: Dict) -> Dict:
         
         # Check if we have the basic required information based on category
         category = info.get('category')
-        
-        # Define required fields by category
-        required_fields = {
-            'Aircon Servicing': ['unit_type', 'service_type', 'hp_size', 'quantity'],
-            'Aircon Installation': ['unit_type', 'hp_size', 'brand', 'quantity'],
-            'Aircon Repair': ['unit_type', 'issue_type', 'quantity'],
-            'Plumber': ['fixture_type', 'issue_type', 'quantity']
-        }
-        
-        # If we have a category, check for missing required fields
-        if category and category in required_fields:
-            for field in required_fields[category]:
-                if field not in info or not info[field]:
-                    # Generate appropriate question based on missing field
-                    if field == 'unit_type':
-                        return {
-                            'has_enough_info': False,
-                            'missing_key': 'unit_type',
-                            'next_question': "What type of aircon unit is it (e.g., window, split, cassette)?"
-                        }
-                    elif field == 'service_type':
-                        return {
-                            'has_enough_info': False,
-                            'missing_key': 'service_type',
-                            'next_question': "What type of service do you need (e.g., basic servicing, chemical cleaning, gas top-up)?"
-                        }
-                    elif field == 'hp_size':
-                        return {
-                            'has_enough_info': False,
-                            'missing_key': 'hp_size',
-                            'next_question': "What is the horsepower (HP) of the aircon unit?"
-                        }
-                    elif field == 'quantity':
-                        # Customize the quantity question based on the category
-                        if category == 'Plumber':
-                            fixture_type = info.get('fixture_type', 'plumbing fixtures')
-                            return {
-                                'has_enough_info': False,
-                                'missing_key': 'quantity',
-                                'next_question': f"How many {fixture_type}s need service?"
-                            }
-                        else:
-                            return {
-                                'has_enough_info': False,
-                                'missing_key': 'quantity',
-                                'next_question': "How many aircon units do you want to service?"
-                            }
-                    elif field == 'brand':
-                        return {
-                            'has_enough_info': False,
-                            'missing_key': 'brand',
-                            'next_question': "What brand of aircon do you want to install?"
-                        }
-                    elif field == 'fixture_type':
-                        return {
-                            'has_enough_info': False,
-                            'missing_key': 'fixture_type',
-                            'next_question': "What type of plumbing fixture needs service (e.g., toilet, sink, pipe)?"
-                        }
-                    elif field == 'issue_type':
-                        if category == 'Plumber':
-                            fixture_type = info.get('fixture_type', 'plumbing fixture')
-                            return {
-                                'has_enough_info': False,
-                                'missing_key': 'issue_type',
-                                'next_question': f"What is the issue with your {fixture_type} (e.g., leaking, clogged, broken)?"
-                            }
-                        else:
-                            return {
-                                'has_enough_info': False,
-                                'missing_key': 'issue_type',
-                                'next_question': "What is the issue with your aircon unit (e.g., not cooling, noise, leaking)?"
-                            }
+        required_fields = _REQUIRED_FIELDS.get(category)
+        
+        # If we know the category, ask for the first missing required field
+        if required_fields:
+            for field in required_fields:
+                if not info.get(field):
+                    return {
+                        'has_enough_info': False,
+                        'missing_key': field,
+                        'next_question': _missing_info_question(category, field, info)
+                    }
             
             # If we have all required fields, we have enough info
             return {
@@ -636,51 +1015,18 @@ def determine_missing_info_with_llm(info: Dict) -> Dict:
                 'next_question': None
             }
         
-        # If we don't have a category yet, use the LLM for more general analysis
-        llm = get_entity_extraction_llm()
-        
-         # Create a system prompt for determining missing information
-        system_prompt = """You are a service quotation assistant. Determine what information is missing to provide an accurate quotation.
-
-For different service categories, we need different information:
-- Aircon Servicing: unit_type, service_type, hp_size, quantity
-- Aircon Installation: unit_type, hp_size, brand, quantity
-- Aircon Repair: unit_type, issue_type, quantity
-- Plumber: fixture_type, issue_type, quantity
-
-Your task is to:
-1. Analyze the information we already have
-2. Determine what critical information is missing
-3. Generate a natural question to ask the user to get this information
-
-Return your response as a JSON object with:
-- has_enough_info: true/false
-- missing_key: the key of the missing information (if any)
-- next_question: the question to ask the user (if needed)
-"""
-        
-        # Create the prompt
-        prompt = f"Determine what information is missing from this context: {json.dumps(info)}"
+        # Otherwise (a category we have no rules for) use the LLM for more general analysis.
+        # Only the gathered service details go in the prompt, compactly and with sorted keys,
+        # so the same details always give the same (cacheable) prompt
+        gathered = {key: value for key, value in info.items() if key not in _PROMPT_EXCLUDED_KEYS and value}
+        prompt = f"Determine what information is missing from this context: {json.dumps(gathered, sort_keys=True, separators=(',', ':'))}"
         
-        # Invoke the LLM
-        response = llm.invoke([
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=prompt)
-        ])
-        
-        # Extract the JSON from the response
-        response_text = response.content
+        # Invoke the LLM and get the response text
+        response_text = _invoke_llm_json_cached(_MISSING_INFO_SYSTEM_PROMPT, prompt)
         
         # Try to find and parse JSON in the response
         try:
-            # Look for JSON pattern
-            json_match = re.search(r'({[\s\S]*})', response_text)
-            if json_match:
-                json_str = json_match.group(1)
-                result = json.loads(json_str)
-            else:
-                # If no JSON pattern found, try to parse the whole response
-                result = json.loads(response_text)
+            result = _parse_json_response(response_text)
             
             # Ensure the result has the required fields
             if 'has_enough_info' not in result:
@@ -706,21 +1052,22 @@ Return your response as a JSON object with:
             }
             
             # Try to extract information from the text
-            if "has enough information" in response_text.lower() or "sufficient information" in response_text.lower():
+            response_lower = response_text.lower()
+            if "has enough information" in response_lower or "sufficient information" in response_lower:
                 result['has_enough_info'] = True
             
             # Extract missing key
-            missing_key_match = re.search(r"missing[_\s]key[:\s]+([a-zA-Z_]+)", response_text, re.IGNORECASE)
+            missing_key_match = _MISSING_KEY_FIELD_RE.search(response_text)
             if missing_key_match:
                 result['missing_key'] = missing_key_match.group(1)
             
             # Extract next question
-            next_question_match = re.search(r"next[_\s]question[:\s]+(.*?)(?:\n|$)", response_text, re.IGNORECASE)
+            next_question_match = _NEXT_QUESTION_FIELD_RE.search(response_text)
             if next_question_match:
                 result['next_question'] = next_question_match.group(1).strip()
             elif "?" in response_text:
                 # Find the first question in the text
-                question_match = re.search(r"([^.!?]+\?)", response_text)
+                question_match = _FIRST_QUESTION_RE.search(response_text)
                 if question_match:
                     result['next_question'] = question_match.group(1).strip()
             
@@ -734,11 +1081,26 @@ Return your response as a JSON object with:
             'next_question': "Could you provide more details about your service request?"
         }
     
+# Description search term for each extracted unit type and service type
+_UNIT_TYPE_SEARCH_TERMS = {
+    'wall': 'wall mounted',
+    'ceiling': 'ceiling',
+    'cassette': 'cassette',
+}
+_SERVICE_TYPE_SEARCH_TERMS = {
+    'basic_servicing': 'basic servicing',
+    'chemical_cleaning': 'chemical',
+    'gas_topup': 'gas',
+}
+
+# Most matches find_matching_services returns (the quotation shows the best and two alternatives)
+_MAX_MATCHES = 10
+
 def find_matching_services(info: Dict) -> List[Dict]:
     """Find services that match the given information using fuzzy matching"""
     try:
         # Get data analysis
-        df = get_quotation_data()
+        analysis = analyze_data()
         
         # Extract key information
         category = info.get('category')
@@ -746,8 +1108,8 @@ def find_matching_services(info: Dict) -> List[Dict]:
             return []
         
         # Filter by category
-        category_df = df[df['category'] == category]
-        if category_df.empty:
+        category_df = analysis['category_frames'].get(category)
+        if category_df is None or category_df.empty:
             return []
         
         # Prepare search terms based on the information we have
@@ -755,57 +1117,44 @@ def find_matching_services(info: Dict) -> List[Dict]:
         
         # Add unit type if available
         if 'unit_type' in info and info['unit_type']:
-            unit_type = info['unit_type'].lower()
-            if unit_type == 'wall':
-                search_terms.append('wall mounted')
-            elif unit_type == 'ceiling':
-                search_terms.append('ceiling')
-            elif unit_type == 'cassette':
-                search_terms.append('cassette')
+            unit_type_term = _UNIT_TYPE_SEARCH_TERMS.get(info['unit_type'].lower())
+            if unit_type_term:
+                search_terms.append(unit_type_term)
         
         # Add service type if available
         if 'service_type' in info and info['service_type']:
-            service_type = info['service_type'].lower()
-            if service_type == 'basic_servicing':
-                search_terms.append('basic servicing')
-            elif service_type == 'chemical_cleaning':
-                search_terms.append('chemical')
-            elif service_type == 'gas_topup':
-                search_terms.append('gas')
+            service_type_term = _SERVICE_TYPE_SEARCH_TERMS.get(info['service_type'].lower())
+            if service_type_term:
+                search_terms.append(service_type_term)
         
         # Add HP size if available - improved non-hardcoded approach
         if 'hp_size' in info and info['hp_size']:
             requested_hp = float(info['hp_size'])
             
-            # First, look for exact matches
+            # First, look for exact matches (e.g., "3.0HP"), taking the first matching
+            # size of each service; categories without HP sizes (plumbing) skip this
             exact_match_found = False
-            for description in category_df['item_description'].tolist():
-                # Look for exact HP match (e.g., "3.0HP")
-                exact_matches = re.findall(r'(\d+\.?\d*)HP(?!\s+TO)', description, re.IGNORECASE)
-                for match in exact_matches:
-                    match_hp = float(match)
-                    if abs(match_hp - requested_hp) < 0.1:  # Allow small difference for rounding
-                        search_terms.append(f"{match}HP")
-                        exact_match_found = True
-                        break
-            
-            # If no exact match, look for ranges
-            if not exact_match_found:
-                for description in category_df['item_description'].tolist():
-                    # Look for HP ranges (e.g., "3.0HP TO 4.0HP")
-                    range_match = re.search(r'(\d+\.?\d*)HP\s+TO\s+(\d+\.?\d*)HP', description, re.IGNORECASE)
-                    if range_match:
-                        range_start = float(range_match.group(1))
-                        range_end = float(range_match.group(2))
-                        if range_start <= requested_hp <= range_end:
-                            range_term = f"{range_match.group(1)}HP TO {range_match.group(2)}HP"
-                            if range_term not in search_terms:
-                                search_terms.append(range_term)
+            hp_values, hp_texts = analysis['hp_exact'][category]
+            if hp_values.shape[1]:
+                hp_hits = np.abs(hp_values - requested_hp) < 0.1  # Allow small difference for rounding
+                hit_rows = np.flatnonzero(hp_hits.any(axis=1))
+                exact_match_found = len(hit_rows) > 0
+                if exact_match_found:
+                    first_hits = hp_hits[hit_rows].argmax(axis=1)
+                    search_terms.extend(f"{hp_text}HP" for hp_text in hp_texts[hit_rows, first_hits])
+            
+            # If no exact match, look for ranges (e.g., "3.0HP TO 4.0HP")
+            range_mins, range_maxs, range_terms = analysis['hp_ranges'][category]
+            if not exact_match_found and len(range_terms):
+                in_range = (range_mins <= requested_hp) & (requested_hp <= range_maxs)
+                for range_term in range_terms[in_range].tolist():
+                    if range_term not in search_terms:
+                        search_terms.append(range_term)
             
             # If still no match, add the requested HP as a search term
             if not search_terms or not exact_match_found:
-                # Format with one decimal place
-                formatted_hp = f"{requested_hp:.1f}".rstrip('0').rstrip('.') if '.' in f"{requested_hp:.1f}" else f"{requested_hp:.0f}"
+                # Format with one decimal place, dropping a trailing ".0" (3.0 -> "3", 2.5 -> "2.5")
+                formatted_hp = f"{requested_hp:.1f}".rstrip('0').rstrip('.')
                 search_terms.append(f"{formatted_hp}HP")
         
         # Add brand if available
@@ -824,39 +1173,68 @@ def find_matching_services(info: Dict) -> List[Dict]:
         if not search_terms:
             return []
         
-        # Calculate match scores for each service
-        matches = []
-        for _, row in category_df.iterrows():
-            description = row['item_description'].lower()
-            
-            # Calculate match score based on search terms
-            match_score = 0
-            for term in search_terms:
-                if term.lower() in description:
-                    match_score += 100 / len(search_terms)
-            
-            # Add fuzzy matching for better results
-            if match_score == 0:
-                # Try fuzzy matching
-                for term in search_terms:
-                    fuzzy_score = fuzz.partial_ratio(term.lower(), description)
-                    match_score += fuzzy_score / len(search_terms)
-            
-            # Only consider matches with a score above 30
-            if match_score >= 30:
-                matches.append({
-                    'invoice_no': row['invoice_no'],
-                    'category': row['category'],
-                    'description': row['item_description'],
-                    'unit_price': float(row['unit_price']),
-                    'subtotal': float(row['subtotal']),
-                    'tax': float(row['tax']),
-                    'total': float(row['total']),
-                    'match_score': match_score
-                })
-        
-        # Sort matches by score (highest first)
-        matches.sort(key=lambda x: x['match_score'], reverse=True)
+        # Calculate match scores for each service: each search term found in a
+        # description contributes an equal share of 100. The HP lookup can add
+        # the same term many times, so score each distinct term once and weight
+        # it by how often it occurs
+        term_counts = {}
+        for term in map(str.lower, search_terms):
+            term_counts[term] = term_counts.get(term, 0) + 1
+        unique_terms = list(term_counts)
+        term_weights = np.array(list(term_counts.values())) * (100 / len(search_terms))
+        
+        descriptions = category_df['item_description_lc']
+        term_hits = np.array([descriptions.str.contains(term, regex=False, na=False).to_numpy(dtype=np.float64) for term in unique_terms])
+        match_scores = term_weights @ term_hits
+        
+        # Add fuzzy matching for better results where no term matched exactly,
+        # scoring all remaining descriptions against all terms in one call
+        no_match = np.flatnonzero(match_scores == 0)
+        if len(no_match):
+            fuzzy_scores = process.cdist(
+                unique_terms,
+                descriptions.to_numpy()[no_match],
+                scorer=fuzz.partial_ratio,
+                dtype=np.float64
+            )
+            match_scores[no_match] = term_weights @ fuzzy_scores / 100
+        
+        # Round away float noise from summing weights so equal scores tie exactly
+        match_scores = match_scores.round(6)
+        
+        # Only consider matches with a score above 30, highest first (ties keep row order).
+        # Callers only show the best few, so rank just the rows that can make the top
+        # _MAX_MATCHES: everything scoring at least the _MAX_MATCHES-th best score
+        matched = np.flatnonzero(match_scores >= 30)
+        if len(matched) > _MAX_MATCHES:
+            cutoff = np.partition(match_scores[matched], -_MAX_MATCHES)[-_MAX_MATCHES]
+            matched = matched[match_scores[matched] >= cutoff]
+        matched = matched[np.argsort(-match_scores[matched], kind='stable')][:_MAX_MATCHES]
+        
+        # Build results from the matched positions of each column
+        matched_df = category_df.iloc[matched]
+        matches = [
+            {
+                'invoice_no': invoice_no,
+                'category': category_value,
+                'description': description,
+                'unit_price': unit_price,
+                'subtotal': subtotal,
+                'tax': tax,
+                'total': total,
+                'match_score': match_score
+            }
+            for invoice_no, category_value, description, unit_price, subtotal, tax, total, match_score in zip(
+                matched_df['invoice_no'].tolist(),
+                matched_df['category'].tolist(),
+                matched_df['item_description'].tolist(),
+                _to_prices(matched_df['unit_price']),
+                _to_prices(matched_df['subtotal']),
+                _to_prices(matched_df['tax']),
+                _to_prices(matched_df['total']),
+                match_scores[matched].tolist()
+            )
+        ]
         
         return matches
     
@@ -864,15 +1242,8 @@ def find_matching_services(info: Dict) -> List[Dict]:
         logger.error(f"Error finding matching services: {e}")
         return []
 
-def generate_quotation(service: Dict, quantity: int = 1) -> str:
-    """Generate a quotation based on the service information and quantity"""
-    description = service['description']
-    unit_price = service['unit_price']
-    subtotal = unit_price * quantity
-    tax = subtotal * 0.08
-    total = subtotal + tax
-    
-    quotation = f"""SERVICE QUOTATION
+# Quotation layout (main.py parses these fields back out for downloads)
+_QUOTATION_TEMPLATE = """SERVICE QUOTATION
 ------------------
 Service Description: {description}
 Quantity: {quantity}
@@ -884,8 +1255,28 @@ Total: {total:.2f}
 This quotation is based on our database of similar services.
 Additional charges may apply depending on specific requirements.
 """
+
+def generate_quotation(service: Dict, quantity: int = 1) -> str:
+    """Generate a quotation based on the service information and quantity"""
+    # Work in whole cents so the printed subtotal and tax always add up to the printed total
+    unit_price_cents = round(service['unit_price'] * 100)
+    subtotal_cents = unit_price_cents * quantity
+    tax_cents = (subtotal_cents * 8 + 50) // 100  # 8%, rounded half up
+    total_cents = subtotal_cents + tax_cents
     
-    return quotation
+    return _QUOTATION_TEMPLATE.format(
+        description=service['description'],
+        quantity=quantity,
+        unit_price=unit_price_cents / 100,
+        subtotal=subtotal_cents / 100,
+        tax=tax_cents / 100,
+        total=total_cents / 100
+    )
+
+# Markers of agent output that leaks raw data or code instead of an answer
+_DATAFRAME_COLUMN_RE = re.compile(r'invoice_no|company_name|item_description')
+_CODE_SNIPPET_RE = re.compile(r'df\[|print\(|\.mean\(\)')
+_PRICE_FIELD_RE = re.compile(r'Price|Subtotal|Total')  # "Unit Price" contains "Price"
 
 def is_problematic_response(response_text):
     """Check if the response is problematic (raw data, code, etc.)"""
@@ -893,11 +1284,11 @@ def is_problematic_response(response_text):
         return True
         
     # Check for raw dataframe output
-    if "rows x" in response_text and any(col in response_text for col in ["invoice_no", "company_name", "item_description"]):
+    if "rows x" in response_text and _DATAFRAME_COLUMN_RE.search(response_text):
         return True
         
     # Check for code snippets
-    if "df[" in response_text or "print(" in response_text or ".mean()" in response_text:
+    if _CODE_SNIPPET_RE.search(response_text):
         return True
         
     # Check for just numbers
@@ -905,100 +1296,107 @@ def is_problematic_response(response_text):
         return True
         
     # Check for "Average" calculations
-    if "Average" in response_text and any(term in response_text for term in ["Price", "Unit Price", "Subtotal", "Total"]):
+    if "Average" in response_text and _PRICE_FIELD_RE.search(response_text):
         return True
         
     return False
 
+def _answer_unit_type(message_lower: str) -> Dict:
+    """Direct answer to a unit_type question"""
+    unit_type = _UNIT_TYPE_ANSWERS.get(message_lower)
+    if unit_type:
+        return {'unit_type': unit_type}
+    return {}
+
+def _answer_hp_size(message_lower: str) -> Dict:
+    """Direct answer to an hp_size question"""
+    # Check for HP in the message
+    hp_match = _HP_RE.search(message_lower)
+    if hp_match:
+        return {'hp_size': hp_match.group(1)}
+    # Check if the message is just a number
+    if _is_plain_number(message_lower):
+        return {'hp_size': message_lower}
+    return {}
+
+def _answer_quantity(message_lower: str) -> Dict:
+    """Direct answer to a quantity question"""
+    # Check if the message is just a number
+    if message_lower.isdecimal():
+        return {'quantity': int(message_lower)}
+    # Check for quantity words
+    quantity = _first_keyword_match(message_lower, _ANSWER_KEYWORDS['quantity'])
+    if quantity:
+        return {'quantity': quantity}
+    return {}
+
+def _answer_from_keywords(question_type: str, message_lower: str) -> Dict:
+    """Direct answer to a question whose answers are keyword tables (service_type, brand, etc.)"""
+    value = _first_keyword_match(message_lower, _ANSWER_KEYWORDS[question_type])
+    if value:
+        return {question_type: value}
+    return {}
+
+# Direct answer handler for each question type we ask
+_DIRECT_ANSWER_HANDLERS = {
+    'unit_type': _answer_unit_type,
+    'service_type': partial(_answer_from_keywords, 'service_type'),
+    'hp_size': _answer_hp_size,
+    'quantity': _answer_quantity,
+    'brand': partial(_answer_from_keywords, 'brand'),
+    'fixture_type': partial(_answer_from_keywords, 'fixture_type'),
+    'issue_type': partial(_answer_from_keywords, 'issue_type'),
+}
+
 def handle_direct_response(message: str, last_question_type: str) -> Dict:
     """Handle direct responses to specific questions"""
-    message_lower = message.lower().strip()
+    handler = _DIRECT_ANSWER_HANDLERS.get(last_question_type)
+    if handler:
+        return handler(message.lower().strip())
     
-    # Handle direct answers to unit_type questions
-    if last_question_type == 'unit_type':
-        if message_lower in ['wall', 'wall mounted', 'wall-mounted']:
-            return {'unit_type': 'wall'}
-        elif message_lower in ['window', 'window unit', 'window-unit', 'window type']:
-            return {'unit_type': 'window'}
-        elif message_lower in ['ceiling', 'ceiling mounted', 'ceiling-mounted']:
-            return {'unit_type': 'ceiling'}
-        elif message_lower in ['cassette', 'cassette type', 'cassette-type']:
-            return {'unit_type': 'cassette'}
-        elif message_lower in ['split', 'split unit', 'split-unit']:
-            return {'unit_type': 'wall'}  # Most split units are wall-mounted
-    
-    # Handle direct answers to service_type questions
-    elif last_question_type == 'service_type':
-        if any(term in message_lower for term in ['basic', 'general', 'normal', 'regular', 'standard']):
-            return {'service_type': 'basic_servicing'}
-        elif any(term in message_lower for term in ['chemical', 'deep', 'thorough', 'complete']):
-            return {'service_type': 'chemical_cleaning'}
-        elif any(term in message_lower for term in ['gas', 'top up', 'refill', 'recharge']):
-            return {'service_type': 'gas_topup'}
-        elif any(term in message_lower for term in ['install', 'installation', 'setup', 'set up']):
-            return {'service_type': 'installation'}
-        elif any(term in message_lower for term in ['repair', 'fix', 'troubleshoot']):
-            return {'service_type': 'repair'}
-    
-    # Handle direct answers to hp_size questions
-    elif last_question_type == 'hp_size':
-        # Check for HP in the message
-        hp_match = re.search(r'(\d+(\.\d+)?)\s*hp', message_lower)
-        if hp_match:
-            return {'hp_size': hp_match.group(1)}
-        # Check if the message is just a number
-        elif re.match(r'^\d+(\.\d+)?$', message_lower):
-            return {'hp_size': message_lower}
-    
-    # Handle direct answers to quantity questions
-    elif last_question_type == 'quantity':
-        # Check if the message is just a number
-        if re.match(r'^\d+$', message_lower):
-            return {'quantity': int(message_lower)}
-        # Check for quantity words
-        quantity_words = {
-            'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
-            'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10
-        }
-        for word, value in quantity_words.items():
-            if word in message_lower:
-                return {'quantity': value}
-    
-    # Handle direct answers to brand questions
-    elif last_question_type == 'brand':
-        common_brands = ['daikin', 'panasonic', 'samsung', 'lg', 'mitsubishi', 'hitachi', 'toshiba', 'sharp', 'carrier']
-        for brand in common_brands:
-            if brand in message_lower:
-                return {'brand': brand}
-    
-    # Handle direct answers to fixture_type questions
-    elif last_question_type == 'fixture_type':
-        if any(term in message_lower for term in ['toilet', 'wc', 'bathroom']):
-            return {'fixture_type': 'toilet'}
-        elif any(term in message_lower for term in ['sink', 'basin', 'tap', 'faucet']):
-            return {'fixture_type': 'sink'}
-        elif any(term in message_lower for term in ['pipe', 'piping', 'water pipe', 'drain']):
-            return {'fixture_type': 'pipe'}
-        elif any(term in message_lower for term in ['water heater', 'heater', 'hot water']):
-            return {'fixture_type': 'water_heater'}
-        elif any(term in message_lower for term in ['water tank', 'tank', 'storage']):
-            return {'fixture_type': 'water_tank'}
-        
-    elif last_question_type == 'issue_type':
-        if any(term in message_lower for term in ['leak', 'leaking', 'water leak']):
-            return {'issue_type': 'leaking'}
-        elif any(term in message_lower for term in ['clog', 'clogged', 'blocked', 'blockage']):
-            return {'issue_type': 'clogged'}
-        elif any(term in message_lower for term in ['broken', 'damaged', 'not working']):
-            return {'issue_type': 'broken'}
-        elif any(term in message_lower for term in ['not cooling', 'no cool', 'warm air']):
-            return {'issue_type': 'not_cooling'}
-        elif any(term in message_lower for term in ['noise', 'noisy', 'loud', 'sound']):
-            return {'issue_type': 'noise'}
-    
-    # No direct match found
+    # No handler for this question type
     return {}
 
+def _no_match_template(service: str, details: List[str]) -> str:
+    """Build the str.format template for a category's no-match price range response"""
+    return (
+        f"I couldn't find an exact match for your requirements, but here's a general price range for {service}:\n\n"
+        "Price range: RM {min:.2f} - RM {max:.2f}\n\n"
+        "To provide a more accurate quotation, could you please provide more specific details about:\n"
+        + ''.join(f"{number}. {detail}\n" for number, detail in enumerate(details, 1))
+    )
+
+# No-match responses per category: (template, default min price, default max price)
+_NO_MATCH_TEMPLATES = {
+    'Aircon Servicing': (_no_match_template('aircon servicing', [
+        "The exact type and model of your aircon unit",
+        "The specific service you need",
+        "Any additional requirements or conditions",
+    ]), 30, 340),
+    'Aircon Installation': (_no_match_template('aircon installation', [
+        "The exact type and model of aircon you want to install",
+        "The installation location and conditions",
+        "Any additional requirements (e.g., extra piping, concealment work)",
+    ]), 550, 4500),
+    'Aircon Repair': (_no_match_template('aircon repair', [
+        "The exact issue with your aircon unit",
+        "The type of unit and its model",
+        "Any additional requirements or conditions",
+    ]), 80, 3850),
+    'Plumber': (_no_match_template('plumbing services', [
+        "The exact plumbing issue or service you need",
+        "The fixtures involved (toilet, sink, pipes, etc.)",
+        "The severity or complexity of the issue",
+    ]), 80, 3850),
+}
+
+_NO_MATCH_GENERIC_RESPONSE = """I couldn't find a match for your requirements. Could you please provide more specific details about the service you need?
+
+For example:
+- For aircon services: type of unit, service needed, horsepower
+- For plumbing services: type of fixture, issue, specific requirements
+"""
+
 def generate_dynamic_response(query: str, context: Dict = None) -> Dict:
     """
     Generate a dynamic response based on the query and context.
@@ -1095,68 +1493,17 @@ This quotation is for \n {best_match['description']} with a match score of {int(
         else:
             # If no matches, provide a generic response based on the category
             category = info.get('category')
-            
-            if category == 'Aircon Servicing':
-                analysis = analyze_data()
-                category_data = analysis['category_analysis'].get(category, {})
-                price_range = category_data.get('price_range', {})
-                
-                response = f"""I couldn't find an exact match for your requirements, but here's a general price range for aircon servicing:
-
-Price range: RM {price_range.get('min', 30):.2f} - RM {price_range.get('max', 340):.2f}
-
-To provide a more accurate quotation, could you please provide more specific details about:
-1. The exact type and model of your aircon unit
-2. The specific service you need
-3. Any additional requirements or conditions
-"""
-            elif category == 'Aircon Installation':
-                    analysis = analyze_data()
-                    category_data = analysis['category_analysis'].get(category, {})
-                    price_range = category_data.get('price_range', {})
-                
-                    response = f"""I couldn't find an exact match for your requirements, but here's a general price range for aircon installation:
-
-Price range: RM {price_range.get('min', 550):.2f} - RM {price_range.get('max', 4500):.2f}
-
-To provide a more accurate quotation, could you please provide more specific details about:
-1. The exact type and model of aircon you want to install
-2. The installation location and conditions
-3. Any additional requirements (e.g., extra piping, concealment work)
-"""
-            elif category == 'Aircon Repair':
-                    analysis = analyze_data()
-                    category_data = analysis['category_analysis'].get(category, {})
-                    price_range = category_data.get('price_range', {})
-                    response = f"""I couldn't find an exact match for your requirements, but here's a general price range for aircon repair:
-
-Price range: RM {price_range.get('min', 80):.2f} - RM {price_range.get('max', 3850):.2f}
-
-To provide a more accurate quotation, could you please provide more specific details about:
-1. The exact issue with your aircon unit
-2. The type of unit and its model
-3. Any additional requirements or conditions
-"""
-            elif category == 'Plumber':
-                analysis = analyze_data()
-                category_data = analysis['category_analysis'].get(category, {})
+            no_match = _NO_MATCH_TEMPLATES.get(category)
+            if no_match:
+                template, default_min, default_max = no_match
+                category_data = analyze_data()['category_analysis'].get(category, {})
                 price_range = category_data.get('price_range', {})
-                response = f"""I couldn't find an exact match for your requirements, but here's a general price range for plumbing services:
-
-Price range: RM {price_range.get('min', 80):.2f} - RM {price_range.get('max', 3850):.2f}
-
-To provide a more accurate quotation, could you please provide more specific details about:
-1. The exact plumbing issue or service you need
-2. The fixtures involved (toilet, sink, pipes, etc.)
-3. The severity or complexity of the issue
-"""
+                response = template.format(
+                    min=price_range.get('min', default_min),
+                    max=price_range.get('max', default_max)
+                )
             else:
-                response = """I couldn't find a match for your requirements. Could you please provide more specific details about the service you need?
-
-For example:
-- For aircon services: type of unit, service needed, horsepower
-- For plumbing services: type of fixture, issue, specific requirements
-"""
+                response = _NO_MATCH_GENERIC_RESPONSE
             
             return {
                 "response": response,
@@ -1174,6 +1521,14 @@ For example:
             "next_question": "Could you please provide more specific details about the service you need?"
         }
 
+def _recent_turns(context: Dict, count: int) -> Tuple:
+    """Return the last `count` (message, response) turns of a session, oldest first"""
+    return tuple(islice(reversed(context.get('chat_history', ())), count))[::-1]
+
+# JSON leftovers stripped from a non-JSON off-topic response before showing it
+_JSON_PUNCTUATION_RE = re.compile(r'["{}\[\]]')
+_OFF_TOPIC_FIELDS_RE = re.compile(r'is_off_topic:\s*true,?\s*response:', re.IGNORECASE)
+
 def detect_and_handle_off_topic_with_llm(message, context):
     """
     Use LLM to detect if a message is off-topic and generate an appropriate response
@@ -1188,9 +1543,6 @@ def detect_and_handle_off_topic_with_llm(message, context):
             # Information requests are on-topic
             return False, None
         
-        # Get the LLM
-        llm = get_entity_extraction_llm()
-        
         # Create context information for the LLM
         context_info = ""
         if context:
@@ -1202,7 +1554,7 @@ def detect_and_handle_off_topic_with_llm(message, context):
             # Add last few messages for context
             if context.get('chat_history'):
                 context_info += "\nRecent conversation:\n"
-                for i, (q, a) in enumerate(context.get('chat_history', [])[-2:]):
+                for i, (q, a) in enumerate(_recent_turns(context, 2)):
                     context_info += f"User: {q}\nAssistant: {a}\n"
         
         # Create a system prompt for off-topic detection and response
@@ -1232,25 +1584,12 @@ Return your response as a JSON object with:
         # Create the prompt
         prompt = f"User message: {message}"
         
-        # Invoke the LLM
-        response = llm.invoke([
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=prompt)
-        ])
-        
-        # Extract the JSON from the response
-        response_text = response.content
+        # Invoke the LLM and get the response text
+        response_text = _invoke_llm_json_cached(system_prompt, prompt)
         
         # Try to find and parse JSON in the response
         try:
-            # Look for JSON pattern
-            json_match = re.search(r'({[\s\S]*})', response_text)
-            if json_match:
-                json_str = json_match.group(1)
-                result = json.loads(json_str)
-            else:
-                # If no JSON pattern found, try to parse the whole response
-                result = json.loads(response_text)
+            result = _parse_json_response(response_text)
             
             is_off_topic = result.get('is_off_topic', False)
             response_text = result.get('response', None)
@@ -1267,8 +1606,8 @@ Return your response as a JSON object with:
             # If it's off-topic, use the whole response as the response text
             if is_off_topic:
                 # Clean up the response to remove JSON-like formatting
-                cleaned_response = re.sub(r'["{}\[\]]', '', response_text)
-                cleaned_response = re.sub(r'is_off_topic:\s*true,?\s*response:', '', cleaned_response, flags=re.IGNORECASE)
+                cleaned_response = _JSON_PUNCTUATION_RE.sub('', response_text)
+                cleaned_response = _OFF_TOPIC_FIELDS_RE.sub('', cleaned_response)
                 return True, cleaned_response.strip()
             
             return False, None
@@ -1278,169 +1617,290 @@ Return your response as a JSON object with:
         # Default to on-topic in case of errors
         return False, None
 
-def is_affirmative_response(message: str) -> bool:
-    """Check if a message is an affirmative response using LLM"""
-    try:
-        # Get the LLM
-        llm = get_entity_extraction_llm()
-        
-        # Create a system prompt for detecting affirmative responses
-        system_prompt = """You are a response classifier. Your task is to determine if a message is an affirmative response.
+# Clear-cut short answers, taken from the classifier prompts' examples, that
+# can be classified without asking the LLM
+_AFFIRMATIVE_ANSWERS = frozenset([
+    'yes', 'yeah', 'yep', 'sure', 'ok', 'okay', 'i do', 'i would', 'please',
+    'of course', 'definitely', 'absolutely', 'certainly'
+])
+_NEGATIVE_ANSWERS = frozenset([
+    'no', 'nope', 'nah', "don't", 'dont', "i don't", 'i dont', 'no thanks', 'no thank you'
+])
+_CONFIRMATION_ANSWERS = frozenset([
+    'yes', 'yeah', 'yep', 'sure', 'ok', 'okay', 'confirm', 'i confirm', 'sounds good',
+    'that works', 'proceed', 'go ahead', 'i accept', 'accept', 'agreed', 'i agree',
+    "that's fine", 'that is fine', 'looks good', 'good'
+])
+
+# Phrase fallbacks for when the reply classifier fails; one alternation per label,
+# so a single search scans the message for any of the phrases
+_AFFIRMATIVE_PHRASE_RE = re.compile('|'.join(map(re.escape, ["yes", "yeah", "yep", "sure", "ok", "okay"])))
+_NEGATIVE_PHRASE_RE = re.compile('|'.join(map(re.escape, ["no", "nope", "nah", "not", "don't", "dont"])))
+_CONFIRMATION_PHRASE_RE = re.compile('|'.join(map(re.escape, ["yes", "confirm", "accept", "agree", "proceed", "ok", "okay"])))
 
-Examples of affirmative responses include: yes, yeah, yep, sure, ok, okay, I do, I would, please, of course, definitely, absolutely, certainly.
+# Replies that end the session after a quotation has been confirmed
+_QUIT_WORDS = frozenset(['quit', 'exit', 'no', 'done', 'finish', 'end'])
 
-Return ONLY a JSON object with a single field "is_affirmative" set to true or false.
+# Punctuation dropped from short answers before the exact lookups ("Yes!", "ok .")
+_SHORT_ANSWER_PUNCTUATION = str.maketrans('', '', '.!')
+
+def _normalize_short_answer(message: str) -> str:
+    """Lowercase a message, drop punctuation and collapse whitespace for exact lookups"""
+    return ' '.join(message.lower().translate(_SHORT_ANSWER_PUNCTUATION).split())
+
+# One classifier prompt for all three reply labels
+_REPLY_CLASSIFIER_PROMPT = """You are a response classifier. Your task is to classify a user's reply in a conversation about service quotations.
+
+Determine:
+- is_affirmative: whether the message is an affirmative response. Examples include: yes, yeah, yep, sure, ok, okay, I do, I would, please, of course, definitely, absolutely, certainly.
+- is_negative: whether the message is a negative response. Examples include: no, nope, nah, not, don't, dont, I don't, I dont, no thanks, no thank you.
+- is_confirmation: whether the message is confirming a quotation or proposal. Examples include: yes, yeah, yep, sure, ok, okay, confirm, I confirm, sounds good, that works, proceed, go ahead, I accept, accept, agreed, I agree, that's fine, that is fine, looks good, good.
+
+Return ONLY a JSON object with the fields "is_affirmative", "is_negative" and "is_confirmation", each set to true or false.
 """
-        
-        # Create the prompt
-        prompt = f"Is this message an affirmative response? Message: '{message}'"
-        
-        # Invoke the LLM
-        response = llm.invoke([
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=prompt)
-        ])
-        
-        # Extract the JSON from the response
-        response_text = response.content
-        
-        # Try to find and parse JSON in the response
-        try:
-            # Look for JSON pattern
-            json_match = re.search(r'({[\s\S]*})', response_text)
-            if json_match:
-                json_str = json_match.group(1)
-                result = json.loads(json_str)
-            else:
-                # If no JSON pattern found, try to parse the whole response
-                result = json.loads(response_text)
-            
-            return result.get('is_affirmative', False)
-        
-        except json.JSONDecodeError:
-            # If JSON parsing fails, check for "true" or "yes" in the response
-            return "true" in response_text.lower() or "yes" in response_text.lower()
+
+def _classify_reply_with_llm(message: str) -> Dict:
+    """
+    Classify a reply as affirmative, negative and/or confirming with a single LLM call.
+    The call is memoized, so checking several labels for one message costs one round-trip.
+    """
+    prompt = f"Classify this message: '{message}'"
+    response_text = _invoke_llm_json_cached(_REPLY_CLASSIFIER_PROMPT, prompt)
+    
+    return _parse_json_response(response_text)
+
+def is_affirmative_response(message: str) -> bool:
+    """Check if a message is an affirmative response using LLM"""
+    # Clear-cut short answers don't need the LLM
+    answer = _normalize_short_answer(message)
+    if answer in _AFFIRMATIVE_ANSWERS:
+        return True
+    if answer in _NEGATIVE_ANSWERS:
+        return False
+    
+    try:
+        # The reply classification labels all three at once, so one LLM call serves all checks
+        return bool(_classify_reply_with_llm(message).get('is_affirmative', False))
     
     except Exception as e:
         logger.error(f"Error in is_affirmative_response: {e}")
         # Fall back to simple pattern matching in case of errors
-        message_lower = message.lower().strip()
-        affirmative_phrases = ["yes", "yeah", "yep", "sure", "ok", "okay"]
-        return any(phrase in message_lower for phrase in affirmative_phrases)
+        return _AFFIRMATIVE_PHRASE_RE.search(message.lower()) is not None
 
 def is_negative_response(message: str) -> bool:
     """Check if a message is a negative response using LLM"""
+    # Clear-cut short answers don't need the LLM
+    answer = _normalize_short_answer(message)
+    if answer in _NEGATIVE_ANSWERS:
+        return True
+    if answer in _AFFIRMATIVE_ANSWERS or answer in _CONFIRMATION_ANSWERS:
+        return False
+    
     try:
-        # Get the LLM
-        llm = get_entity_extraction_llm()
-        
-        # Create a system prompt for detecting negative responses
-        system_prompt = """You are a response classifier. Your task is to determine if a message is a negative response.
-
-Examples of negative responses include: no, nope, nah, not, don't, dont, I don't, I dont, no thanks, no thank you.
-
-Return ONLY a JSON object with a single field "is_negative" set to true or false.
-"""
-        
-        # Create the prompt
-        prompt = f"Is this message a negative response? Message: '{message}'"
-        
-        # Invoke the LLM
-        response = llm.invoke([
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=prompt)
-        ])
-        
-        # Extract the JSON from the response
-        response_text = response.content
-        
-        # Try to find and parse JSON in the response
-        try:
-            # Look for JSON pattern
-            json_match = re.search(r'({[\s\S]*})', response_text)
-            if json_match:
-                json_str = json_match.group(1)
-                result = json.loads(json_str)
-            else:
-                # If no JSON pattern found, try to parse the whole response
-                result = json.loads(response_text)
-            
-            return result.get('is_negative', False)
-        
-        except json.JSONDecodeError:
-            # If JSON parsing fails, check for "true" or "yes" in the response
-            return "true" in response_text.lower() or "yes" in response_text.lower()
+        # The reply classification labels all three at once, so one LLM call serves all checks
+        return bool(_classify_reply_with_llm(message).get('is_negative', False))
     
     except Exception as e:
         logger.error(f"Error in is_negative_response: {e}")
         # Fall back to simple pattern matching in case of errors
-        message_lower = message.lower().strip()
-        negative_phrases = ["no", "nope", "nah", "not", "don't", "dont"]
-        return any(phrase in message_lower for phrase in negative_phrases)
+        return _NEGATIVE_PHRASE_RE.search(message.lower()) is not None
 
 def is_confirmation_message(message: str) -> bool:
     """Check if a message is confirming a quotation using LLM"""
+    # Clear-cut short answers don't need the LLM
+    answer = _normalize_short_answer(message)
+    if answer in _CONFIRMATION_ANSWERS:
+        return True
+    if answer in _NEGATIVE_ANSWERS:
+        return False
+    
     try:
-        # Get the LLM
-        llm = get_entity_extraction_llm()
-        
-        # Create a system prompt for detecting confirmation messages
-        system_prompt = """You are a response classifier. Your task is to determine if a message is confirming a quotation or proposal.
-
-Examples of confirmation messages include: yes, yeah, yep, sure, ok, okay, confirm, I confirm, sounds good, that works, proceed, 
-go ahead, I accept, accept, agreed, I agree, that's fine, that is fine, looks good, good.
-
-Return ONLY a JSON object with a single field "is_confirmation" set to true or false.
-"""
-        
-        # Create the prompt
-        prompt = f"Is this message confirming a quotation? Message: '{message}'"
-        
-        # Invoke the LLM
-        response = llm.invoke([
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=prompt)
-        ])
-        
-        # Extract the JSON from the response
-        response_text = response.content
-        
-        # Try to find and parse JSON in the response
-        try:
-            # Look for JSON pattern
-            json_match = re.search(r'({[\s\S]*})', response_text)
-            if json_match:
-                json_str = json_match.group(1)
-                result = json.loads(json_str)
-            else:
-                # If no JSON pattern found, try to parse the whole response
-                result = json.loads(response_text)
-            
-            return result.get('is_confirmation', False)
-        
-        except json.JSONDecodeError:
-            # If JSON parsing fails, check for "true" or "yes" in the response
-            return "true" in response_text.lower() or "yes" in response_text.lower()
+        # The reply classification labels all three at once, so one LLM call serves all checks
+        return bool(_classify_reply_with_llm(message).get('is_confirmation', False))
     
     except Exception as e:
         logger.error(f"Error in is_confirmation_message: {e}")
         # Fall back to simple pattern matching in case of errors
-        message_lower = message.lower().strip()
-        confirmation_phrases = ["yes", "confirm", "accept", "agree", "proceed", "ok", "okay"]
-        return any(phrase in message_lower for phrase in confirmation_phrases)
+        return _CONFIRMATION_PHRASE_RE.search(message.lower()) is not None
    
+# Context keys that are bookkeeping rather than information about the service request
+_PROMPT_EXCLUDED_KEYS = frozenset([
+    'chat_history', 'last_query', 'information_gathering_stage', 'missing_info',
+    'last_question_type', 'last_quotation', 'quotation_confirmed', 'asked_for_another_quotation'
+])
+
+def _build_agent_system_prompt(system_prompt: str, context: Dict) -> str:
+    """Build the agent's system prompt from the base prompt and the information gathered so far"""
+    if not system_prompt:
+        system_prompt = get_default_system_prompt()
+    gathered = tuple((key, value) for key, value in context.items() if key not in _PROMPT_EXCLUDED_KEYS and value)
+    try:
+        return _agent_system_prompt_cached(system_prompt, gathered)
+    except TypeError:
+        # Unhashable values (e.g. a list from the LLM) can't be cached
+        return _agent_system_prompt_cached.__wrapped__(system_prompt, gathered)
+
+@lru_cache(maxsize=256)
+def _agent_system_prompt_cached(system_prompt: str, gathered: Tuple) -> str:
+    """Assemble the agent's system prompt; memoized since the gathered info rarely changes between turns"""
+    info = dict(gathered)
+    category = info.get('category')
+    
+    # Add context-specific instructions to the system prompt
+    if category:
+        system_prompt += f"\n\nThe user is asking about {category}."
+        
+        if category == 'Aircon Servicing' and info.get('service_type') == 'chemical_cleaning':
+            system_prompt += " Focus on chemical cleaning services, not basic servicing."
+        elif category == 'Aircon Installation':
+            system_prompt += " Focus on installation services and costs."
+        elif category == 'Aircon Repair':
+            system_prompt += " Focus on repair services and costs."
+        elif category == 'Plumber':
+            system_prompt += " Focus on plumbing-related services and costs."
+    
+    # Add information about what we already know
+    system_prompt += "\n\nInformation gathered so far:"
+    for key, value in gathered:
+        system_prompt += f"\n- {key}: {value}"
+    
+    return system_prompt
+
+def _answer_with_agent(message: str, system_prompt: str, recent_history: Tuple) -> str:
+    """
+    Answer a message with the pandas dataframe agent, or return None if it only produced raw data or code.
+    Answers are memoized on the message, a digest of the system prompt (which carries the gathered info)
+    and recent history, so a repeated question in the same conversation state skips the agent's LLM calls.
+    None is not cached, so asking again gives the agent another try.
+    """
+    key = (message, hashlib.sha1(system_prompt.encode()).digest(), recent_history)
+    response_text = _lru_get(_agent_answer_cache, key)
+    if response_text is None:
+        response_text = _run_agent(message, system_prompt, recent_history)
+        if response_text is not None:
+            _lru_put(_agent_answer_cache, key, response_text, _MAX_AGENT_ANSWERS)
+    return response_text
+
+def _run_agent(message: str, system_prompt: str, recent_history: Tuple) -> str:
+    """Invoke the dataframe agent for a message (retrying once with stricter instructions), or return None if it only produced raw data or code"""
+    # Build chat history for context
+    chat_history = [SystemMessage(content=system_prompt)] 
+    
+    for i, (q, a) in enumerate(recent_history):
+        chat_history.append(HumanMessage(content=q))
+        chat_history.append(SystemMessage(content=a))
+    
+    # A fresh agent, so nothing an earlier question's code did to the data carries over
+    agent = create_dataframe_agent()
+    
+    # Enhance the message with instructions based on the context
+    enhanced_message = f"""
+    {message}
+    
+    IMPORTANT: 
+    1. DO NOT calculate averages or sums across all services.
+    2. DO NOT return raw dataframes or code.
+    3. DO NOT provide a quotation until you have all necessary details.
+    4. Ask follow-up questions to gather all required information.
+    5. If you don't have enough information, ask specific questions.
+    """
+    
+    # Add the current message to chat history
+    chat_history.append(HumanMessage(content=enhanced_message))
+    
+    # Invoke the agent
+    response = agent.invoke({
+        "input": enhanced_message,
+        "chat_history": chat_history
+    })
+    
+      # Extract the output text
+    if isinstance(response, dict) and 'output' in response:
+        response_text = response['output']
+    else:
+        response_text = str(response)
+    
+    # Check if the response is problematic
+    if is_problematic_response(response_text):
+        logger.warning(f"Detected problematic response: {response_text}")
+        
+        # Try again with more specific instructions
+        retry_message = f"""
+        {message}
+        
+        CRITICAL INSTRUCTIONS:
+        1. DO NOT show any code, dataframes, or raw data in your response.
+        2. DO NOT calculate averages or sums across all services.
+        3. DO NOT just return a number.
+        4. Instead, ask specific questions to gather more information about what the user needs.
+        5. DO NOT provide a quotation until you have all necessary details.
+        """
+        
+        # Retry with more specific instructions
+        retry_response = agent.invoke({
+            "input": retry_message,
+            "chat_history": chat_history
+        })
+        
+        # Extract the retry output
+        if isinstance(retry_response, dict) and 'output' in retry_response:
+            retry_text = retry_response['output']
+        else:
+            retry_text = str(retry_response)
+        
+        # Check if retry is still problematic
+        if is_problematic_response(retry_text):
+            return None
+        response_text = retry_text
+    
+    return response_text
+
+def _touch_session(session_id: str):
+    """Mark a session as just active and drop expired or excess sessions (caller holds _session_lock)"""
+    now = time.monotonic()
+    _conversation_context.move_to_end(session_id)
+    _session_last_active[session_id] = now
+    
+    # Sessions are ordered by last activity, so only the oldest ones need checking
+    while len(_conversation_context) > 1:
+        oldest = next(iter(_conversation_context))
+        if len(_conversation_context) <= _MAX_SESSIONS and now - _session_last_active[oldest] < _SESSION_TTL_SECONDS:
+            break
+        del _conversation_context[oldest]
+        del _session_last_active[oldest]
+        del _session_locks[oldest]
+        logger.info(f"Dropped inactive session {oldest}")
+
+def get_session_context(session_id: str):
+    """Get a session's conversation context, or None if the session doesn't exist (or was dropped)"""
+    with _session_lock:
+        return _conversation_context.get(session_id)
+
 def process_message(message: str, session_id: str = "default", system_prompt: str = None):
     """Process a message and generate a response"""
     global _conversation_context
     
+    # The session's lock once acquired; released when the message is done
+    session_lock = None
     try:
         # Log the incoming request
         logger.info(f"Processing message for session {session_id}: {message}")
+        message_lower = message.lower()
         
         # Check for reset command
-        if message.lower() == 'reset':
-            if session_id in _conversation_context:
-                del _conversation_context[session_id]
+        if message_lower == 'reset':
+            with _session_lock:
+                lock = _session_locks.get(session_id)
+            if lock:
+                # Let a message in progress for this session finish before dropping it
+                lock.acquire()
+                session_lock = lock
+            with _session_lock:
+                # Unless the session was dropped and recreated while we waited
+                if _session_locks.get(session_id) is lock:
+                    _conversation_context.pop(session_id, None)
+                    _session_last_active.pop(session_id, None)
+                    _session_locks.pop(session_id, None)
             return {
                 "response": "Conversation has been reset. How can I help you today?",
                 "display_quotation": False,
@@ -1448,27 +1908,36 @@ def process_message(message: str, session_id: str = "default", system_prompt: st
             }
         
         # Get or initialize conversation context
-        if session_id not in _conversation_context:
-            _conversation_context[session_id] = {
-                'category': None,
-                'unit_type': None,
-                'service_type': None,
-                'hp_size': None,
-                'brand': None,
-                'fixture_type': None,
-                'issue_type': None,
-                'quantity': None,
-                'chat_history': [],
-                'last_query': None,
-                'last_question_type': None,
-                'information_gathering_stage': True,
-                'missing_info': [],
-                'last_quotation': None,  # Store the last quotation
-                'quotation_confirmed': False,  # Track if quotation is confirmed
-                'asked_for_another_quotation': False  # Track if we've asked for another quotation
-            }
+        with _session_lock:
+            if session_id not in _conversation_context:
+                _conversation_context[session_id] = {
+                    'category': None,
+                    'unit_type': None,
+                    'service_type': None,
+                    'hp_size': None,
+                    'brand': None,
+                    'fixture_type': None,
+                    'issue_type': None,
+                    'quantity': None,
+                    'chat_history': deque(maxlen=_MAX_CHAT_HISTORY),
+                    'last_query': None,
+                    'last_question_type': None,
+                    'information_gathering_stage': True,
+                    'missing_info': [],
+                    'last_quotation': None,  # Store the last quotation
+                    'quotation_confirmed': False,  # Track if quotation is confirmed
+                    'asked_for_another_quotation': False  # Track if we've asked for another quotation
+                }
+                _session_locks[session_id] = threading.Lock()
+            
+            context = _conversation_context[session_id]
+            lock = _session_locks[session_id]
+            _touch_session(session_id)
         
-        context = _conversation_context[session_id]
+        # Hold the session's lock for the rest of the message, so two requests for the same
+        # session (a double submit, a reset mid-turn) can't change its context at the same time
+        lock.acquire()
+        session_lock = lock
         
         # Determine user intent
         user_intent = classify_user_intent(message, context)
@@ -1512,7 +1981,7 @@ def process_message(message: str, session_id: str = "default", system_prompt: st
         # Check if user is responding to "would you like another quotation" question
         if context.get('asked_for_another_quotation') and context.get('quotation_confirmed'):
             # Check if user wants to quit
-            if message.lower() in ['quit', 'exit', 'no', 'done', 'finish', 'end']:
+            if message_lower in _QUIT_WORDS:
                 response = "Thank you for using our service! Your quotations are ready for download. If you need anything else in the future, just start a new chat."
                 context['chat_history'].append((message, response))
                 return {
@@ -1521,59 +1990,68 @@ def process_message(message: str, session_id: str = "default", system_prompt: st
                     "quotation": None
                 }
             
-            # If user wants another quotation, reset relevant parts of the context
-            if is_affirmative_response(message) or message.lower() not in ['quit', 'exit', 'no', 'done', 'finish', 'end']:
-                # Keep the chat history but reset the service-specific information
-                context['category'] = None
-                context['unit_type'] = None
-                context['service_type'] = None
-                context['hp_size'] = None
-                context['brand'] = None
-                context['fixture_type'] = None
-                context['issue_type'] = None
-                context['quantity'] = None
-                context['last_quotation'] = None
-                context['quotation_confirmed'] = False
-                context['asked_for_another_quotation'] = False
-                context['information_gathering_stage'] = True
-                
-                response = "Great! What type of service would you like a quotation for? (e.g., Aircon Servicing, Aircon Installation, Aircon Repair, or Plumber)"
-                context['chat_history'].append((message, response))
-                return {
-                    "response": response,
-                    "display_quotation": False,
-                    "quotation": None
-                }
-        
-        # Check if message is off-topic using LLM
-        is_off_topic, off_topic_response = detect_and_handle_off_topic_with_llm(message, context)
-        if is_off_topic and off_topic_response:
-            context['chat_history'].append((message, off_topic_response))
+            # Anything other than a quit word means the user wants another quotation:
+            # keep the chat history but reset the service-specific information
+            context['category'] = None
+            context['unit_type'] = None
+            context['service_type'] = None
+            context['hp_size'] = None
+            context['brand'] = None
+            context['fixture_type'] = None
+            context['issue_type'] = None
+            context['quantity'] = None
+            context['last_quotation'] = None
+            context['quotation_confirmed'] = False
+            context['asked_for_another_quotation'] = False
+            context['information_gathering_stage'] = True
+            
+            response = "Great! What type of service would you like a quotation for? (e.g., Aircon Servicing, Aircon Installation, Aircon Repair, or Plumber)"
+            context['chat_history'].append((message, response))
             return {
-                "response": off_topic_response,
+                "response": response,
                 "display_quotation": False,
                 "quotation": None
             }
         
+        # A message that plainly answers the question we just asked is on-topic, and its
+        # entities are parsed without the LLM, so it can skip the off-topic check
+        entities_future = None
+        if user_intent != "direct_answer" or not handle_direct_response(message, context.get('last_question_type')):
+            # Start extracting entities while the off-topic check runs; neither depends on the other
+            entities_future = _llm_executor.submit(extract_entities_with_llm, message, context)
+            
+            # Check if message is off-topic using LLM
+            is_off_topic, off_topic_response = detect_and_handle_off_topic_with_llm(message, context)
+            if is_off_topic and off_topic_response:
+                # The entities aren't needed; drop the extraction if it hasn't started yet
+                entities_future.cancel()
+                context['chat_history'].append((message, off_topic_response))
+                return {
+                    "response": off_topic_response,
+                    "display_quotation": False,
+                    "quotation": None
+                }
+        
         # For direct answers to specific questions in the quotation flow,
         # make sure we're correctly handling numeric inputs
         if user_intent == "direct_answer" and context.get('information_gathering_stage'):
-            if context.get('last_question_type') == 'quantity' and message.strip().isdigit():
+            answer = message_lower.strip()
+            if context.get('last_question_type') == 'quantity' and answer.isdigit():
                 # This is a direct quantity answer, store it properly
-                quantity = int(message.strip())
+                quantity = int(answer)
                 context['quantity'] = quantity
                 logger.info(f"Updated context quantity = {quantity}")
                 
-            elif context.get('last_question_type') == 'hp_size' and re.match(r'^\d+(\.\d+)?(\s*hp)?$', message.lower()):
+            elif context.get('last_question_type') == 'hp_size':
                 # This is a direct HP size answer
-                hp_match = re.search(r'(\d+(\.\d+)?)', message.lower())
+                hp_match = _HP_ANSWER_RE.match(message_lower)
                 if hp_match:
                     hp_size = hp_match.group(1)
                     context['hp_size'] = hp_size
                     logger.info(f"Updated context hp_size = {hp_size}")
         
         # Extract entities from the message
-        new_entities = extract_entities_with_llm(message, context)
+        new_entities = entities_future.result() if entities_future else extract_entities_with_llm(message, context)
         
         # Update context with new entities
         for key, value in new_entities.items():
@@ -1621,119 +2099,14 @@ def process_message(message: str, session_id: str = "default", system_prompt: st
         
         # If dynamic response didn't work, use the agent as fallback
         try:
-            # Get data
-            df = get_quotation_data()
-            
-            # Initialize LLM
-            llm = ChatGoogleGenerativeAI(
-                model="gemini-2.0-flash", 
-                api_key=GEMINI_API_KEY,
-                temperature=0.2
-            )
-            
             # Create system prompt
-            if not system_prompt:
-                system_prompt = get_default_system_prompt()
-            
-            # Add context-specific instructions to the system prompt
-            if context['category']:
-                system_prompt += f"\n\nThe user is asking about {context['category']}."
-                
-                if context['category'] == 'Aircon Servicing' and context['service_type'] == 'chemical_cleaning':
-                    system_prompt += " Focus on chemical cleaning services, not basic servicing."
-                elif context['category'] == 'Aircon Installation':
-                    system_prompt += " Focus on installation services and costs."
-                elif context['category'] == 'Aircon Repair':
-                    system_prompt += " Focus on repair services and costs."
-                elif context['category'] == 'Plumber':
-                    system_prompt += " Focus on plumbing-related services and costs."
-            
-            # Add information about what we already know
-            system_prompt += "\n\nInformation gathered so far:"
-            for key, value in context.items():
-                if key not in ['chat_history', 'last_query', 'information_gathering_stage', 'missing_info', 
-                              'last_question_type', 'last_quotation', 'quotation_confirmed', 'asked_for_another_quotation'] and value:
-                    system_prompt += f"\n- {key}: {value}"
-            
-            # Build chat history for context
-            chat_history = [SystemMessage(content=system_prompt)] 
-            
-            for i, (q, a) in enumerate(context.get('chat_history', [])[-3:]):
-                chat_history.append(HumanMessage(content=q))
-                chat_history.append(SystemMessage(content=a))
-            
-            # Create agent
-            agent = create_pandas_dataframe_agent(
-                llm, 
-                df,
-                verbose=True,
-                agent_type="zero-shot-react-description",
-                handle_parsing_errors=True,
-                max_iterations=3,
-                allow_dangerous_code=True
-            )
-            
-            # Enhance the message with instructions based on the context
-            enhanced_message = f"""
-            {message}
+            system_prompt = _build_agent_system_prompt(system_prompt, context)
             
-            IMPORTANT: 
-            1. DO NOT calculate averages or sums across all services.
-            2. DO NOT return raw dataframes or code.
-            3. DO NOT provide a quotation until you have all necessary details.
-            4. Ask follow-up questions to gather all required information.
-            5. If you don't have enough information, ask specific questions.
-            """
-            
-            # Add the current message to chat history
-            chat_history.append(HumanMessage(content=enhanced_message))
-            
-            # Invoke the agent
-            response = agent.invoke({
-                "input": enhanced_message,
-                "chat_history": chat_history
-            })
-            
-              # Extract the output text
-            if isinstance(response, dict) and 'output' in response:
-                response_text = response['output']
-            else:
-                response_text = str(response)
-            
-            # Check if the response is problematic
-            if is_problematic_response(response_text):
-                logger.warning(f"Detected problematic response: {response_text}")
-                
-                # Try again with more specific instructions
-                retry_message = f"""
-                {message}
-                
-                CRITICAL INSTRUCTIONS:
-                1. DO NOT show any code, dataframes, or raw data in your response.
-                2. DO NOT calculate averages or sums across all services.
-                3. DO NOT just return a number.
-                4. Instead, ask specific questions to gather more information about what the user needs.
-                5. DO NOT provide a quotation until you have all necessary details.
-                """
-                
-                # Retry with more specific instructions
-                retry_response = agent.invoke({
-                    "input": retry_message,
-                    "chat_history": chat_history
-                })
-                
-                # Extract the retry output
-                if isinstance(retry_response, dict) and 'output' in retry_response:
-                    retry_text = retry_response['output']
-                else:
-                    retry_text = str(retry_response)
-                
-                # Check if retry is still problematic
-                if is_problematic_response(retry_text):
-                    # Fall back to dynamic response
-                    response_text = dynamic_result['response']
-                else:
-                    response_text = retry_text
+            # Answer with the agent; repeated questions in the same state reuse its answer
+            response_text = _answer_with_agent(message, system_prompt, _recent_turns(context, 3))
+            if response_text is None:
+                # Fall back to dynamic response
+                response_text = dynamic_result['response']
             
             # Update chat history with the response
             context['chat_history'].append((message, response_text))
@@ -1763,10 +2136,17 @@ def process_message(message: str, session_id: str = "default", system_prompt: st
             "response": f"I apologize, but I encountered an error. Could you please try again with more specific details?",
             "display_quotation": False,
             "quotation": None
-        }  
+        }
+    finally:
+        if session_lock is not None:
+            session_lock.release()
     
 def get_default_system_prompt():
-    """Get the default system prompt based on the data"""
+    """Get the default system prompt based on the data (built once per data load)"""
+    global _default_system_prompt
+    if _default_system_prompt is not None:
+        return _default_system_prompt
+    
     try:
         # Get data analysis
         analysis = analyze_data()
@@ -1776,7 +2156,7 @@ def get_default_system_prompt():
         categories_str = ", ".join(categories)
         
         # Create the system prompt
-        return f"""You are a quotation generator for services including: {categories_str}.
+        _default_system_prompt = f"""You are a quotation generator for services including: {categories_str}.
 
 IMPORTANT INSTRUCTIONS:
 1. NEVER calculate averages or sums across all services in the database.
@@ -1795,6 +2175,7 @@ When responding to pricing questions:
 
 For follow-up questions, maintain context from previous messages.
 """
+        return _default_system_prompt
     except Exception as e:
         logger.error(f"Error generating system prompt: {e}")
         return """You are a quotation generator for air-conditioning and plumbing services.
@@ -1819,14 +2200,26 @@ For follow-up questions, maintain context from previous messages.
 
 def refresh_data():
     """Refresh the data cache"""
-    global _df_cache, _data_analysis_cache, _conversation_context, _entity_extraction_llm, _search_llm
-    _df_cache = None
-    _data_analysis_cache = None
-    _conversation_context = {}
-    _entity_extraction_llm = None
-    _search_llm = None
-    get_quotation_data()  # This will refresh the data cache
-    analyze_data()  # This will refresh the data analysis
+    global _df_cache, _data_analysis_cache, _conversation_context, _session_last_active, _session_locks, _entity_extraction_llm, _search_llm, _entity_system_message, _agent_frame, _default_system_prompt
+    with _cache_lock:
+        _df_cache = None
+        _data_analysis_cache = None
+        with _session_lock:
+            _conversation_context = OrderedDict()
+            _session_last_active = {}
+            _session_locks = {}
+        _entity_extraction_llm = None
+        _search_llm = None
+        _entity_system_message = None
+        _agent_frame = None
+        _default_system_prompt = None
+        _classify_intent_by_keywords.cache_clear()
+        _entity_cache.clear()
+        _llm_json_cache.clear()
+        _agent_answer_cache.clear()
+        _agent_system_prompt_cached.cache_clear()
+        get_quotation_data()  # This will refresh the data cache
+        analyze_data()  # This will refresh the data analysis
     return "Data cache and analysis refreshed"
 
 def main():
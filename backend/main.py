@@ -1,5 +1,6 @@
 from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, Dict, List
@@ -47,6 +48,9 @@ async def startup_event():
         # Initialize the chatbot data
         chatbot.get_quotation_data()
         chatbot.analyze_data()
+        # Create the LLM clients now so the first chat request doesn't pay for it
+        chatbot.get_entity_extraction_llm()
+        chatbot.get_search_llm()
         logger.info("Chatbot data initialized successfully")
     except Exception as e:
         logger.error(f"Error initializing chatbot data: {e}")
@@ -63,7 +67,9 @@ async def chat(request: ChatRequest):
         message = str(request.message) if request.message else ""
         session_id = str(request.session_id) if request.session_id else "default"
         
-        result = chatbot.process_message(message, session_id)
+        # process_message blocks on LLM calls, so run it off the event loop to
+        # let requests from other sessions proceed concurrently
+        result = await run_in_threadpool(chatbot.process_message, message, session_id)
         logger.info(f"Chat processing result: {result}")
         return JSONResponse(content=result)
     except Exception as e:
@@ -76,7 +82,7 @@ async def reset_chat(request: ResetRequest):
     """Reset a chat session"""
     try:
         logger.info(f"Resetting chat session: {request.session_id}")
-        result = chatbot.process_message('reset', request.session_id)
+        result = await run_in_threadpool(chatbot.process_message, 'reset', request.session_id)
         return JSONResponse(content={"success": True, "message": "Chat session reset"})
     except Exception as e:
         logger.error(f"Error resetting chat session: {e}")
@@ -88,7 +94,7 @@ async def refresh_data():
     """Refresh the data cache"""
     try:
         logger.info("Refreshing data cache")
-        message = chatbot.refresh_data()
+        message = await run_in_threadpool(chatbot.refresh_data)
         return JSONResponse(content={"success": True, "message": message})
     except Exception as e:
         logger.error(f"Error refreshing data: {e}")
@@ -235,14 +241,12 @@ async def download_quotations(
     try:
         logger.info(f"Downloading quotations for session: {session_id}")
         
-        # Check if the session exists
-        if session_id not in chatbot._conversation_context:
+        # Get the context from the session (looked up in one step, since sessions can be dropped concurrently)
+        context = chatbot.get_session_context(session_id)
+        if context is None:
             logger.warning(f"Session not found: {session_id}")
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # Get the context from the session
-        context = chatbot._conversation_context[session_id]
-        
         # Parse quotations from the request if provided
         quotation_data = []
         if quotations: